@@ -1,6 +1,11 @@
+import datetime as dt
+import functools
+from itertools import chain
+import os
 import pathlib
 import sqlite3
-from typing import List, Optional, Tuple
+import threading
+from typing import Iterator, List, Optional, Tuple, Union
 
 from pystonks.utils.structures.caching import CacheAPI, ReadOnlyCacheAPI
 
@@ -8,6 +13,41 @@ SQL_DATE_FMT = '%Y-%m-%d'
 SQL_TIME_FMT = '%H:%M:%S.%f%:z'
 SQL_DT_FMT = SQL_DATE_FMT + 'T' + SQL_TIME_FMT
 
+# sqlite3 keeps the prepared statements per connection keyed by the sql text, the lookups only differ in
+# their parameters so every shape the traders use fits with room to spare
+STATEMENT_CACHE_SIZE = 512
+
+# 256MB of page cache and a 2GB mmap per connection, the simulator reads the same days every generation
+# connections are kept per thread and per process, so the page cache is paid for by each of them
+READ_ONLY_PRAGMAS = [
+    'cache_size=-262144',
+    'temp_store=memory',
+    'mmap_size=2147483648',
+    'query_only=on',
+]
+
+
+# keys bound per values list, every key is a few parameters and sqlite limits how many a query can bind
+KEYS_PER_QUERY = 400
+
+
+def values_chunks(keys: List[tuple]) -> Iterator[Tuple[str, tuple]]:
+    # splits the keys into '(values (?, ?), ...)' lists small enough to bind, along with their parameters
+    for ci in range(0, len(keys), KEYS_PER_QUERY):
+        chunk = keys[ci:ci + KEYS_PER_QUERY]
+        row = '({})'.format(', '.join(['?'] * len(chunk[0])))
+        yield f'(values {",".join([row] * len(chunk))})', tuple(chain.from_iterable(chunk))
+
+
+@functools.lru_cache(maxsize=4096)
+def _format_sql_date(day: dt.date) -> str:
+    return day.strftime(SQL_DATE_FMT)
+
+
+def sql_date(date: Union[dt.datetime, dt.date]) -> str:
+    # the same few days get formatted by every check, load and save, keyed by the day so the timezone doesn't matter
+    return _format_sql_date(date.date() if isinstance(date, dt.datetime) else date)
+
 
 class SqliteController:
     _instances = {}
@@ -37,7 +77,11 @@ class SqliteController:
     def connect(self):
         if self.conn is not None:
             self.close()
-        self.conn = sqlite3.connect(self.loc)
+        self.conn = sqlite3.connect(self.loc, cached_statements=STATEMENT_CACHE_SIZE)
+        # wal lets the readers keep going during a write, and with it a commit doesn't have to wait on an fsync
+        self.conn.execute('pragma journal_mode=wal')
+        self.conn.execute('pragma synchronous=normal')
+        self.conn.execute('pragma temp_store=memory')
 
     def commit(self):
         if self.conn is not None:
@@ -88,16 +132,34 @@ class ReadOnlySqliteController:
 
     def __init__(self, loc: Optional[pathlib.Path] = None):
         self.loc = loc
+        self.local = threading.local()
+
+    def __getstate__(self):
+        # connections can't be pickled, the copy opens its own
+        return {'loc': self.loc}
+
+    def __setstate__(self, state):
+        self.__init__(state['loc'])
+
+    def connect(self) -> sqlite3.Connection:
+        # one connection per thread and process, kept open so the page cache and the mmap survive between queries
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.loc, cached_statements=STATEMENT_CACHE_SIZE)
+            for pragma in READ_ONLY_PRAGMAS:
+                conn.execute(f'pragma {pragma}')
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
 
     def query(self, query: str, params: Optional[tuple] = None) -> list:
-        with sqlite3.connect(self.loc) as conn:
-            cur = conn.cursor()
-            if params:
-                cur.execute(query, params)
-            else:
-                cur.execute(query)
-            rows = cur.fetchall()
-            cur.close()
+        cur = self.connect().cursor()
+        if params:
+            cur.execute(query, params)
+        else:
+            cur.execute(query)
+        rows = cur.fetchall()
+        cur.close()
         return rows
 
 
@@ -1,10 +1,11 @@
+import datetime as dt
 import os
 import pathlib
 import random as rng
 import tempfile
 import unittest
 
-from pystonks.apis.sql import SqliteAPI, SqliteController
+from pystonks.apis.sql import SqliteAPI, SqliteController, sql_date
 
 
 def table_exists(instance: SqliteAPI, name: str) -> bool:
@@ -61,5 +62,12 @@ class SqlTestCase(unittest.TestCase):
         self.assertEqual(table_row_count(self.sql_instance, tname), 1, 'row should be inserted')
 
 
+class SqlDateTestCase(unittest.TestCase):
+    def test_sql_date_types(self):
+        self.assertEqual(sql_date(dt.date(2024, 3, 1)), '2024-03-01', 'plain dates should be formatted')
+        self.assertEqual(sql_date(dt.datetime(2024, 3, 1, 15, 30, tzinfo=dt.UTC)), '2024-03-01',
+                         'datetimes should be formatted by their day')
+
+
 if __name__ == '__main__':
     unittest.main()
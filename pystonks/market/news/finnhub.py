@@ -1,11 +1,12 @@
 import datetime as dt
 import http.client
 import time
+from itertools import chain
 from typing import List
 
 import finnhub
 
-from pystonks.apis.sql import SQL_DATE_FMT
+from pystonks.apis.sql import sql_date
 from pystonks.facades import NewsDataAPI
 from pystonks.models import News
 from pystonks.utils.processing import process_interval, truncate_datetime
@@ -45,13 +46,13 @@ class FinnhubNewsAPI(CachedClass, NewsDataAPI):
         return self.cache_check(
             'news_date_processed',
             condition='symbol = ? and date = ?',
-            params=(symbol, date.strftime(SQL_DATE_FMT))
+            params=(symbol, sql_date(date))
         )
 
     def save_exists(self, symbol: str, date: dt.datetime):
         self.cache_save(
             'news_date_processed',
-            params=(symbol, date.strftime(SQL_DATE_FMT))
+            params=(symbol, sql_date(date))
         )
 
     def news_request(self, symbol: str, date: str) -> List[dict]:
@@ -72,7 +73,7 @@ class FinnhubNewsAPI(CachedClass, NewsDataAPI):
 
     def news(self, symbol: str) -> List[News]:
         date = dt.date.today()
-        data = self.news_request(symbol, date.strftime(SQL_DATE_FMT))
+        data = self.news_request(symbol, sql_date(date))
         return [
             News(
                 symbol,
@@ -89,7 +90,7 @@ class FinnhubNewsAPI(CachedClass, NewsDataAPI):
             return self.check_exists(symbol, date)
 
         def fetcher(date: dt.datetime) -> List[News]:
-            data = self.news_request(symbol, date.strftime(SQL_DATE_FMT))
+            data = self.news_request(symbol, sql_date(date))
             return [
                 News(
                     symbol,
@@ -102,7 +103,7 @@ class FinnhubNewsAPI(CachedClass, NewsDataAPI):
 
         def loader(date: dt.datetime) -> List[News]:
             rows = self.cache_lookup('news', condition='symbol = ? and date(updated_at) = ?',
-                                     params=(symbol, date.strftime(SQL_DATE_FMT)))
+                                     params=(symbol, sql_date(date)))
             return [
                 News(symbol, dt.datetime.fromisoformat(ts), nid, a, h, u, dt.datetime.fromisoformat(ua))
                 for nid, _, ts, ua, a, h, u in rows
@@ -128,7 +129,4 @@ class FinnhubNewsAPI(CachedClass, NewsDataAPI):
         if len(news_params) > 0:
             self.cache_save_many('news', news_params)
 
-        result = []
-        for c in collated:
-            result += c
-        return result
+        return list(chain.from_iterable(collated))
@@ -7,7 +7,7 @@ from polygon.enums import TickerType, TickerMarketType
 from tqdm import tqdm
 import yfinance as yf
 
-from pystonks.apis.sql import SQL_DATE_FMT
+from pystonks.apis.sql import sql_date
 from pystonks.facades import SymbolDataAPI, TradingAPI, MarketDataAPI
 from pystonks.market.filter import TickerFilter, StaticTickerFilter
 from pystonks.models import TickerMeta
@@ -116,11 +116,11 @@ class PolyHooSymbolData(CachedClass, SymbolDataAPI):
 
         def checker(date: dt.datetime) -> bool:
             return self.cache_check('yahoo_meta', condition='name = ? and date = ?',
-                                    params=(symbol, date.strftime(SQL_DATE_FMT)))
+                                    params=(symbol, sql_date(date)))
 
         def loader(date: dt.datetime) -> TickerMeta:
             row = self.cache_lookup('yahoo_meta', condition='name = ? and date = ?',
-                                    params=(symbol, date.strftime(SQL_DATE_FMT)))
+                                    params=(symbol, sql_date(date)))
             _, _, op, hgh = row[0]
             cso = -1 if op < 0 or hgh < 0 else (hgh - op) / op
             return TickerMeta(symbol, date, fl, hgh, op, cso)
@@ -141,7 +141,7 @@ class PolyHooSymbolData(CachedClass, SymbolDataAPI):
 
         def saver(date: dt.datetime, row: TickerMeta):
             params = (
-                row.symbol, date.strftime(SQL_DATE_FMT),
+                row.symbol, sql_date(date),
                 row.open, row.current_price
             )
             cache_params.append(params)
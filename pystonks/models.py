@@ -1,4 +1,5 @@
 import datetime as dt
+from typing import Optional
 
 from pystonks.apis.sql import SQL_DT_FMT
 
@@ -22,6 +23,14 @@ class Bar(HistoricalData):
         self.high = h
         self.low = lw
         self.volume = volume
+        self._second_offset: Optional[int] = None
+
+    @property
+    def second_offset(self) -> int:
+        # seconds since midnight, cached because the plots rebuild their time axis on every refresh
+        if self._second_offset is None:
+            self._second_offset = self.timestamp.hour * 3600 + self.timestamp.minute * 60 + self.timestamp.second
+        return self._second_offset
 
     def zero(self) -> bool:
         return self.open == 0 and self.close == 0 and self.low == 0 and self.volume == 0
@@ -8,7 +8,6 @@ from pathlib import Path
 from typing import List, Optional, Dict, Tuple
 
 import matplotlib.pyplot as plt
-import torch
 from tqdm import tqdm
 
 root_project_path = os.path.abspath(os.path.join('../../..'))
@@ -29,11 +28,12 @@ from pystonks.supervised.annotations.utils.gui import GeneralStockPlot
 from pystonks.supervised.annotations.utils.metric_setup import MetricSetupFunc, SMA_SETUP_REGEX, setup_sma, \
     EMA_SETUP_REGEX, setup_ema, setup_signal, setup_macd
 from pystonks.supervised.annotations.utils.metrics import StockMetric, \
-    StockMetricModule
+    StockMetricModule, process_derivatives
 from pystonks.supervised.annotations.utils.models import PlotStateInfo, GeneralStockPlotInfo
 from pystonks.supervised.annotations.utils.plotters import DefaultBarNewsPlotter, DefaultAnnotationPlotter, \
     DefaultStatePlotter, DefaultVolumePlotter, DefaultDerivativeStatePlotter, AutoAnnotationPlotter
 from pystonks.supervised.training.definitions import INPUT_COUNT
+from pystonks.supervised.training.nn import load_network
 from pystonks.utils.config import read_config
 from pystonks.utils.gui.tk_modules import TkLabelModule, TkFrameModule, TkButtonModule, TkRadioSelection, \
     TkListboxModule, TkToggleButtonModule
@@ -256,6 +256,7 @@ class Window:
         self.plot_data.update_bars(pbars)
         for m in self.metric_dict:
             self.metric_dict[m].reset()
+        process_derivatives(self.labeled_metrics, self.plot_data)
         self.auto_annotator.process_annotations(self.entry_index, self.plot_data)
         self.root_tk.title(f'Annotating stock market data for {self.ticker} on {self.date.strftime(SQL_DATE_FMT)}')
 
@@ -384,19 +385,19 @@ class Window:
         self.update_annotations()
 
     def __adopt_autos(self):
-        if len(self.auto_annotator.auto_annotations) == 0:
+        if self.auto_annotator.idxs is None or len(self.auto_annotator.idxs) == 0:
             return
 
-        for idx, act in self.auto_annotator.auto_annotations:
+        for idx, code in zip(self.auto_annotator.idxs, self.auto_annotator.codes):
             self.controllers.create_annotation(Annotation(self.ticker,
                                                           self.bars[idx].timestamp,
-                                                          act))
+                                                          TradeActions(int(code))))
 
         self.update_annotation_entry_count()
         self.update_annotations()
 
-        self.auto_annotator.auto_annotations = None
-        self.update_display()
+        self.auto_annotator.clear_annotations()
+        self.update_display(True)
 
     def __get_index_from_time(self, time: int):
         index = 0
@@ -467,9 +468,9 @@ class Window:
     def update_annotation_entry_count(self):
         self.entry_count.set(f'Symbol Days entered: {self.controllers.finished_annotations_count()}')
 
-    def update_display(self):
+    def update_display(self, rebuild: bool = False):
         self.tk_plt_canvas.update_display(
-            self.plot_state, self.plot_data
+            self.plot_state, self.plot_data, rebuild
         )
 
     def update_info_frame(self):
@@ -499,7 +500,7 @@ class Window:
     def handle_metric_toggle(self, state: bool):
         for lbl in self.metric_toggles:
             self.metric_dict[lbl].enabled = self.metric_toggles[lbl].toggle_status.get() == 1
-        self.update_display()
+        self.update_display(True)
 
     def find_simulated_profit(self) -> Tuple[float, int, int, str]:
         first_error_index = -1
@@ -686,7 +687,7 @@ if __name__ == '__main__':
     annotator = MACDAnnotator()
     if args.use_model and args.model.exists():
         print('loading saved model...')
-        model = torch.load(args.model)
+        model = load_network(args.model)
         annotator = NeuralNetworkAnnotator(1000, INPUT_COUNT, model)
 
     metrics = args.metrics
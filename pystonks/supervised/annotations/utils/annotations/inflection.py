@@ -1,72 +1,114 @@
-from typing import List, Tuple, Dict
+from typing import List, Tuple, Dict, Callable
 
-from tqdm import tqdm
+import numpy as np
 
-from pystonks.models import Bar
 from pystonks.supervised.annotations.models import TradeActions
 from pystonks.supervised.annotations.utils.annotations.annotator import Annotator
 from pystonks.supervised.annotations.utils.metrics import StockMetric, SMAStockMetric
 from pystonks.supervised.annotations.utils.models import GeneralStockPlotInfo
-from pystonks.utils.processing import calculate_normalized_derivatives
+from pystonks.utils.jit import njit
 
 
-class PeakAnnotator(Annotator):
-    def __init__(self, trough_limit: float = 0.1, peak_limit: float = 0.8):
-        self.trough_limit = trough_limit
-        self.peak_limit = peak_limit
+PEAK_SCANS: Dict[Tuple[int, int, int], Callable] = {}
 
-    def annotate(self, start: int, data: GeneralStockPlotInfo,
-                 metrics: Dict[str, StockMetric]) -> List[Tuple[int, TradeActions]]:
-        smas: List[SMAStockMetric] = [metrics[k] for k in metrics if isinstance(metrics[k], SMAStockMetric)]
-        swin = sorted(smas, key=lambda s: s.module.window)
 
-        if len(swin) < 3 or len(data.bars) < swin[-1].module.window + 2:
-            return []
+def _make_peak_scan(w_lo: int, w_mid: int, w_hi: int) -> Callable:
+    # the windows are baked into the kernel as constants, so each configuration only gets jitted once
+    key = (w_lo, w_mid, w_hi)
+    if key in PEAK_SCANS:
+        return PEAK_SCANS[key]
 
-        for s in smas:
-            if s.first_derivative is None:
-                s.process_all(data)
+    buy_half = TradeActions.BUY_HALF.value
+    sell_half = TradeActions.SELL_HALF.value
+    sell_all = TradeActions.SELL_ALL.value
+
+    @njit
+    def scan(start, closes, d1_lo, d1_hi, d2_mid, d2_hi, trough_limit):
+        n = len(closes)
+        idxs = np.empty(max(n - start, 0), dtype=np.int64)
+        actions = np.empty(max(n - start, 0), dtype=np.int64)
+        count = 0
 
         holding = False
         last_buy = -1
         last_sell = -1
-        result = []
 
-        for i in tqdm(range(start, len(data.bars)), desc='Creating Automated Annotations'):
-            ad1l = abs(swin[0].first_derivative[i - swin[0].module.window])
+        for i in range(start, n):
+            ad1l = abs(d1_lo[i - w_lo])
 
-            if not holding and ad1l < self.trough_limit < swin[-1].first_derivative[i - swin[-1].module.window]:
-                result.append((i, TradeActions.BUY_HALF))
+            if not holding and ad1l < trough_limit < d1_hi[i - w_hi]:
+                idxs[count] = i
+                actions[count] = buy_half
+                count += 1
                 holding = True
                 last_buy = i
                 continue
 
-            if not holding or (holding and (i - last_buy) < 3):
+            if not holding or (i - last_buy) < 3:
                 continue
 
-            change_since_buy = (data.bars[i].close - data.bars[last_buy].close) / data.bars[last_buy].close
-            change_since_sell = ((data.bars[i].close - data.bars[last_sell].close) / data.bars[last_sell].close) \
-                if last_sell >= 0 else 100
+            change_since_buy = (closes[i] - closes[last_buy]) / closes[last_buy]
+            change_since_sell = ((closes[i] - closes[last_sell]) / closes[last_sell]) if last_sell >= 0 else 100.
 
             if ((last_sell < 0 or change_since_sell >= 0.01)
-                    and change_since_buy >= 0.01 and ad1l < self.trough_limit):
-                result.append((i, TradeActions.SELL_HALF))
+                    and change_since_buy >= 0.01 and ad1l < trough_limit):
+                idxs[count] = i
+                actions[count] = sell_half
+                count += 1
                 last_sell = i
                 continue
 
-            if i == len(data.bars) - 1 and holding:
-                result.append((i, TradeActions.SELL_ALL))
+            if i == n - 1:
+                idxs[count] = i
+                actions[count] = sell_all
+                count += 1
                 holding = False
                 last_sell = i
                 continue
 
-            d2m = swin[1].second_derivative[i - swin[1].module.window]
-            d2h = swin[-1].second_derivative[i - swin[-1].module.window]
+            d2m = d2_mid[i - w_mid]
+            d2h = d2_hi[i - w_hi]
 
             if ((last_sell < 0 or change_since_sell >= 0.01) and change_since_buy >= 0.01 and
-                    d2m < 0 < d2h < self.trough_limit and ad1l < self.trough_limit):
-                result.append((i, TradeActions.SELL_ALL))
+                    d2m < 0 < d2h < trough_limit and ad1l < trough_limit):
+                idxs[count] = i
+                actions[count] = sell_all
+                count += 1
                 holding = False
                 last_sell = i
 
-        return result
+        return idxs[:count], actions[:count]
+
+    PEAK_SCANS[key] = scan
+    return scan
+
+
+class PeakAnnotator(Annotator):
+    def __init__(self, trough_limit: float = 0.1, peak_limit: float = 0.8):
+        self.trough_limit = trough_limit
+        self.peak_limit = peak_limit
+
+    def annotate(self, start: int, data: GeneralStockPlotInfo,
+                 metrics: Dict[str, StockMetric]) -> List[Tuple[int, TradeActions]]:
+        smas: List[SMAStockMetric] = [metrics[k] for k in metrics if isinstance(metrics[k], SMAStockMetric)]
+        swin = sorted(smas, key=lambda s: s.module.window)
+
+        if len(swin) < 3 or len(data.bars) < swin[-1].module.window + 2:
+            return []
+
+        for s in smas:
+            if s.first_derivative is None:
+                s.process_all(data)
+
+        scan = _make_peak_scan(swin[0].module.window, swin[1].module.window, swin[-1].module.window)
+        idxs, actions = scan(
+            start,
+            np.asarray(data.closes, dtype=np.float64),
+            np.asarray(swin[0].first_derivative, dtype=np.float64),
+            np.asarray(swin[-1].first_derivative, dtype=np.float64),
+            np.asarray(swin[1].second_derivative, dtype=np.float64),
+            np.asarray(swin[-1].second_derivative, dtype=np.float64),
+            self.trough_limit
+        )
+
+        return [(int(i), TradeActions(int(a))) for i, a in zip(idxs, actions)]
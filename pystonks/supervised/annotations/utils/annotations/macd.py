@@ -1,17 +1,13 @@
 import enum
 from typing import Dict, List, Tuple
 
+import numpy as np
 from tqdm import tqdm
 
 from pystonks.supervised.annotations.models import TradeActions
 from pystonks.supervised.annotations.utils.annotations.annotator import Annotator
 from pystonks.supervised.annotations.utils.metrics import StockMetric, EMAStockMetric, MACDStockMetric, SignalLineMetric
 from pystonks.supervised.annotations.utils.models import GeneralStockPlotInfo
-from pystonks.utils.processing import datetime_to_second_offset
-
-
-def data_arrays_to_dict(times: List[int], values: List[float]) -> Dict[int, float]:
-    return {t:v for t, v in zip(times, values)}
 
 
 class CrossoverTypes(enum.Enum):
@@ -44,6 +40,23 @@ def detect_macd_signal_crossover(
     return CrossoverTypes.POSITIVE if cm > cs else CrossoverTypes.NONE
 
 
+def detect_macd_signal_crossovers(macd: List[float], signal: List[float], offset: int) -> np.ndarray:
+    # vectorized detect_macd_signal_crossover, signal[i] lines up with macd[i + offset]
+    # returns the CrossoverTypes value for every signal index
+    m = np.asarray(macd, dtype=np.float64)[offset:offset + len(signal)]
+    s = np.asarray(signal, dtype=np.float64)[:len(m)]
+
+    result = np.full(len(m), CrossoverTypes.NONE.value, dtype=np.int8)
+    if len(m) < 2:
+        return result
+
+    pm, ps = m[:-1], s[:-1]
+    cm, cs = m[1:], s[1:]
+    result[1:][(pm < ps) & (cm >= cs)] = CrossoverTypes.POSITIVE.value
+    result[1:][(pm > ps) & (cm <= cs)] = CrossoverTypes.NEGATIVE.value
+    return result
+
+
 class MACDAnnotator(Annotator):
     def annotate(
             self, start: int,
@@ -64,7 +77,6 @@ class MACDAnnotator(Annotator):
 
         holding = False
         last_buy = -1
-        last_sell = -1
         result = []
 
         _, macd_raw = macd.get_data(data)
@@ -76,21 +88,15 @@ class MACDAnnotator(Annotator):
         if len(macd_raw) < len(data.bars):
             macd_offset = len(data.bars) - len(macd_raw)
 
-        for bi, b in tqdm(enumerate(data.bars[start:]), desc='Creating Automated MACD/Signal Annotations'):
-            idx = start + bi - macd_offset
-
-            if idx < signal_line.module.window:
-                continue
-
-            crossover = detect_macd_signal_crossover(
-                idx,
-                macd_raw,
-                idx - signal_line.module.window,
-                signal_raw
-            )
-            if crossover == CrossoverTypes.NONE:
-                continue
-            elif crossover == CrossoverTypes.POSITIVE and (last_buy < 0 or idx - last_buy > 10):
+        window = signal_line.module.window
+        crossovers = detect_macd_signal_crossovers(macd_raw, signal_raw, window)
+        first = max(start - macd_offset - window, 0)
+        candidates = np.flatnonzero(crossovers[first:]) + first
+
+        for si in tqdm(candidates, desc='Creating Automated MACD/Signal Annotations'):
+            idx = int(si) + window
+            crossover = CrossoverTypes(crossovers[si])
+            if crossover == CrossoverTypes.POSITIVE and (last_buy < 0 or idx - last_buy > 10):
                 if 0 < idx < len(data.bars) - 1 and (ema_d2[idx-1] > 0 or ema_d1[idx-1] > 0):
                     result.append((idx, TradeActions.BUY_HALF))
                     holding = True
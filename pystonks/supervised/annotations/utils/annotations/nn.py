@@ -1,26 +1,36 @@
-from typing import List, Tuple, Dict
+import copy
+from typing import List, Tuple, Dict, Optional
 
+import numpy as np
 import torch
 from torch import nn as tnn
 
-from pystonks.models import Bar
 from pystonks.supervised.annotations.models import TradeActions
 from pystonks.supervised.annotations.utils.annotations.annotator import Annotator
 from pystonks.supervised.annotations.utils.metrics import StockMetric
 from pystonks.supervised.annotations.utils.models import GeneralStockPlotInfo
 from pystonks.supervised.training.definitions import USE_PERCENTS, DEVICE
-from pystonks.supervised.training.processing import generate_input_data, handle_simulated_model_response
+from pystonks.supervised.training.nn import is_quantized
+from pystonks.supervised.training.processing import flatten_bars, weave_input_data, handle_simulated_model_response
 
 
 class NeuralNetworkAnnotator(Annotator):
-    def __init__(self, initial_balance: float, inputs: int, network: tnn.Module):
+    def __init__(self, initial_balance: float, inputs: int, network: tnn.Module, dtype: Optional[torch.dtype] = None):
         self.inputs = inputs
-        self.model = network
+        if is_quantized(network):
+            # int8 quantized networks only run on the cpu and take float32 inputs
+            self.device = 'cpu'
+            self.dtype = torch.float32
+            self.model = network.eval()
+        else:
+            self.device = DEVICE
+            # half precision is only worth it on cuda, cpus without bf16 support are much slower with it
+            self.dtype = dtype if dtype is not None else (torch.float16 if DEVICE == 'cuda' else torch.float32)
+            # converted on a copy, casting in place would leave the caller's model in half precision too
+            self.model = copy.deepcopy(network).to(DEVICE).to(dtype=self.dtype).eval()
         self.initial_balance = initial_balance
         self.balance = self.initial_balance
         self.shares = 0
-        self.model.to(DEVICE)
-        self.model.eval()
 
     def reset(self):
         self.balance = self.initial_balance
@@ -30,12 +40,15 @@ class NeuralNetworkAnnotator(Annotator):
                  metrics: Dict[str, StockMetric]) -> List[Tuple[int, TradeActions]]:
         self.reset()
         actions = []
+        # flattened once, every step only looks at a longer prefix of it
+        window = flatten_bars(data.bars, np.float64).reshape(-1, 6)
         with torch.no_grad():
             for di in range(len(data.bars[start:])):
-                dslice = data.bars[:start + di + 1]
-                input_data = generate_input_data(self.balance, self.shares, USE_PERCENTS, self.inputs, dslice)
-                input_data = input_data.to(DEVICE)
-                pred = self.model(input_data)
+                input_data = weave_input_data(self.balance, self.shares, USE_PERCENTS, self.inputs,
+                                              window[:start + di + 1])
+                input_data = input_data.to(self.device, dtype=self.dtype)
+                # as a batch of one, the quantized linear layers don't take 1d inputs
+                pred = self.model(input_data.unsqueeze(0))[0]
                 action = TradeActions(pred.argmax(0).item())
                 self.balance, self.shares = handle_simulated_model_response(
                     self.balance, self.shares,
@@ -1,4 +1,4 @@
-from typing import Optional, List
+from typing import Optional, List, Tuple
 
 from matplotlib.gridspec import GridSpec
 import matplotlib.pyplot as plt
@@ -25,10 +25,33 @@ class GeneralStockPlot(TkCanvasModule):
 
         self.pre_legend_metrics = pre_legend_metrics
         self.post_legend_metrics = post_legend_metrics
+        self.drawn: Optional[Tuple[int, bool, Optional[Tuple[int, int]]]] = None
 
         super().__init__(self.plt_fig, dark, master, **pack_kwargs)
 
-    def update_display(self, state: PlotStateInfo, info: GeneralStockPlotInfo):
+    def update_display(self, state: PlotStateInfo, info: GeneralStockPlotInfo, rebuild: bool = False):
+        # the axes only need to be rebuilt when the data or the zoom changes, otherwise the plotters
+        # update the artists they already have
+        drawn = (info.version, state.is_zoomed, state.zoom_lim)
+        if rebuild or drawn != self.drawn:
+            self.drawn = drawn
+            self.__rebuild(state, info)
+        else:
+            axes_info = self.get_axes_info()
+            for metric in self.pre_legend_metrics + self.post_legend_metrics:
+                metric.plot(axes_info, state, info)
+
+        self.plt_fig.canvas.draw_idle()
+
+    def get_axes_info(self) -> StockAxesInfo:
+        return StockAxesInfo(
+            self.plt_ax,
+            self.vax,
+            self.d1ax,
+            self.d2ax
+        )
+
+    def __rebuild(self, state: PlotStateInfo, info: GeneralStockPlotInfo):
         self.plt_ax.cla()
         self.plt_ax.set_title("Candlestick Data")
 
@@ -36,12 +59,10 @@ class GeneralStockPlot(TkCanvasModule):
         self.d1ax.cla()
         self.d2ax.cla()
 
-        axes_info = StockAxesInfo(
-            self.plt_ax,
-            self.vax,
-            self.d1ax,
-            self.d2ax
-        )
+        axes_info = self.get_axes_info()
+
+        for metric in self.pre_legend_metrics + self.post_legend_metrics:
+            metric.clear_artists()
 
         for metric in self.pre_legend_metrics:
             metric.plot(axes_info, state, info)
@@ -57,6 +78,3 @@ class GeneralStockPlot(TkCanvasModule):
         if self.dark:
             self.plt_ax.set_facecolor(DARK_MODE_COLOR)
             self.plt_fig.patch.set_facecolor(DARK_MODE_COLOR)
-
-        self.plt_fig.canvas.draw()
-
@@ -1,6 +1,8 @@
 from abc import ABC, abstractmethod
 from typing import Callable, List, Tuple, Optional
 
+import numpy as np
+
 from pystonks.models import Bar
 from pystonks.supervised.annotations.utils.models import StockPlotter, StockAxesInfo, GeneralStockPlotInfo, \
     PlotStateInfo
@@ -8,7 +10,7 @@ from pystonks.supervised.annotations.utils.processing import place_on_avg
 from pystonks.supervised.annotations.utils.tk_modules import SMAInfoModule, EMAInfoModule
 from pystonks.utils.gui.tk_modules import TkLabelModule
 from pystonks.utils.processing import calculate_normalized_derivatives, create_continuous_sma, create_continuous_ema, \
-    create_ema, calculate_normalized_price_derivatives
+    create_ema, calculate_normalized_price_derivatives, calculate_normalized_price_derivatives_batch
 
 METRIC_HANDLER = Callable[[List[Bar]], Tuple[List[int], List[float]]]
 
@@ -16,20 +18,25 @@ METRIC_HANDLER = Callable[[List[Bar]], Tuple[List[int], List[float]]]
 class StockMetric(ABC):
     def __init__(self):
         self.result: Optional[Tuple[List[int], List[float]]] = None
+        self.result_version = -1
         self.enabled = True
 
     def reset(self):
         self.result = None
+        self.result_version = -1
 
     @abstractmethod
     def process_data(self, data: GeneralStockPlotInfo) -> Tuple[List[int], List[float]]:
         pass
 
     def get_data(self, data: Optional[GeneralStockPlotInfo] = None) -> Tuple[List[int], List[float]]:
+        if self.result and data and data.version != self.result_version:
+            self.reset()
         if not self.result:
             if not data:
                 raise Exception('metric fetched without bar data to process')
             self.result = self.process_data(data)
+            self.result_version = data.version
         return self.result
 
 
@@ -43,11 +50,15 @@ class StockMetricModule(StockMetric, ABC):
         self.label_format = label_format
         self.first_derivative: Optional[List[float]] = None
         self.second_derivative: Optional[List[float]] = None
+        self.timestamps: Optional[np.ndarray] = None
+        self.labeled_index = -2
 
     def reset(self):
         super().reset()
         self.first_derivative = None
         self.second_derivative = None
+        self.timestamps = None
+        self.labeled_index = -2
 
     def process_derivatives(self, data: GeneralStockPlotInfo):
         times, mdata = self.get_data(data)
@@ -61,18 +72,12 @@ class StockMetricModule(StockMetric, ABC):
             self.process_derivatives(data)
 
     def __find_timestamp_index(self, ts: float) -> int:
-        X, _ = self.get_data()
-
-        if len(X) < 1 or ts < X[0]:
-            return -1
-
-        for xi, x in enumerate(X):
-            if x > ts:
-                return (xi - 1) if xi > 0 else 0
-            if x == ts:
-                return xi
+        if self.timestamps is None:
+            X, _ = self.get_data()
+            self.timestamps = np.asarray(X)
 
-        return len(X)-1
+        # times are increasing, so the last time <= ts, or -1 if ts comes before all of them
+        return int(np.searchsorted(self.timestamps, ts, side='right')) - 1
 
     def update_labels(self, timestamp: float, data: GeneralStockPlotInfo):
         _, raw_y = self.get_data(data)
@@ -80,6 +85,11 @@ class StockMetricModule(StockMetric, ABC):
             self.process_derivatives(data)
         index = self.__find_timestamp_index(timestamp)
 
+        # the labels already show this bar
+        if index == self.labeled_index:
+            return
+        self.labeled_index = index
+
         raw, d1, d2 = self.labels
 
         if index < 0:
@@ -105,12 +115,35 @@ class StockMetricModule(StockMetric, ABC):
             d2.set(self.label_format.format(self.label_text + "''", -1))
 
 
+def process_derivatives(metrics: List[StockMetricModule], data: GeneralStockPlotInfo):
+    # fills in the derivatives of every metric that doesn't have them yet with a single stacked computation
+    pending = [m for m in metrics if m.first_derivative is None]
+    series = [m.get_data(data) for m in pending]
+    pending = [m for m, (times, _) in zip(pending, series) if len(times) > 0]
+    series = [s for s in series if len(s[0]) > 0]
+    if len(pending) == 0:
+        return
+
+    length = max(len(times) for times, _ in series)
+    stimes = np.full((len(series), length), np.nan)
+    svalues = np.full((len(series), length), np.nan)
+    for si, (times, values) in enumerate(series):
+        stimes[si, :len(times)] = times
+        svalues[si, :len(values)] = values
+
+    d1, d2 = calculate_normalized_price_derivatives_batch(stimes, svalues, data.closes)
+    for m, (times, _), md1, md2 in zip(pending, series, d1, d2):
+        m.first_derivative = md1[:max(len(times) - 1, 0)]
+        m.second_derivative = md2[:max(len(times) - 2, 0)]
+
+
 class StockMetricPlotterModule(StockMetricModule, StockPlotter, ABC):
     def __init__(self, label: str,
                  raw_label: TkLabelModule, d1_label: TkLabelModule, d2_label: TkLabelModule,
                  linewidth: float, zorder: int, colors: Optional[Tuple[str, str, str]] = None,
                  label_format: str = '{}: ${:0.2f}'):
         super().__init__(label, raw_label, d1_label, d2_label, label_format)
+        StockPlotter.__init__(self)
         self.colors = colors
         self.linewidth = linewidth
         self.zorder = zorder
@@ -120,21 +153,23 @@ class StockMetricPlotterModule(StockMetricModule, StockPlotter, ABC):
 
     def plot(self, axes: StockAxesInfo, state: PlotStateInfo, data: GeneralStockPlotInfo):
         if not self.enabled:
+            for key in self.artists:
+                self.hide_artist(key)
             return
 
         times, raw = self.prepare_plotting_data(state, data)
         if self.first_derivative is None:
             self.process_derivatives(data)
 
+        kwargs = [{}, {}, {}]
         if self.colors:
-            cr, d1r, d2r = self.colors
-            axes.default.plot(times, raw, label=self.label_text, linewidth=self.linewidth, c=cr, zorder=self.zorder)
-            axes.d1.plot(times[1:], self.first_derivative, label=self.label_text, linewidth=self.linewidth, c=d1r, zorder=self.zorder)
-            axes.d2.plot(times[1:-1], self.second_derivative, label=self.label_text, linewidth=self.linewidth, c=d2r, zorder=self.zorder)
-        else:
-            axes.default.plot(times, raw, label=self.label_text, linewidth=self.linewidth, zorder=self.zorder)
-            axes.d1.plot(times[1:], self.first_derivative, label=self.label_text, linewidth=self.linewidth, zorder=self.zorder)
-            axes.d2.plot(times[1:-1], self.second_derivative, label=self.label_text, linewidth=self.linewidth, zorder=self.zorder)
+            kwargs = [{'c': c} for c in self.colors]
+        self.update_line(axes.default, 'raw', times, raw,
+                         label=self.label_text, linewidth=self.linewidth, zorder=self.zorder, **kwargs[0])
+        self.update_line(axes.d1, 'd1', times[1:], self.first_derivative,
+                         label=self.label_text, linewidth=self.linewidth, zorder=self.zorder, **kwargs[1])
+        self.update_line(axes.d2, 'd2', times[1:-1], self.second_derivative,
+                         label=self.label_text, linewidth=self.linewidth, zorder=self.zorder, **kwargs[2])
 
 
 class SMAStockMetric(StockMetricPlotterModule):
@@ -188,9 +223,7 @@ class MACDStockMetric(StockMetricPlotterModule):
         if dat[0] != dbt[0]:
             raise Exception('macd cannot handle emas with different starting times, add more historical data')
 
-        macd = [day[i] - dby[i] for i in range(len(dat))]
-
-        return dat, macd
+        return dat, np.subtract(day, dby)
 
 
 class SignalLineMetric(StockMetricPlotterModule):
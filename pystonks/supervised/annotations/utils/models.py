@@ -1,7 +1,10 @@
 from abc import ABC, abstractmethod
-from typing import List, Optional, Tuple
+import itertools
+from typing import Dict, List, Optional, Tuple
 
+from matplotlib.artist import Artist
 import matplotlib.pyplot as plt
+import numpy as np
 
 from pystonks.models import Bar, News
 from pystonks.supervised.annotations.models import Annotation
@@ -16,46 +19,59 @@ class StockAxesInfo:
         self.d2 = d2
 
 
+# every rebuild of the plot data draws a new version so that metrics can tell when their cache is stale
+DATA_VERSIONS = itertools.count()
+
+
+def _bars_to_soa(bars: List[Bar]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # single pass over the bars, returns contiguous opens, closes, highs, lows, times, volumes
+    # prices are only displayed and fed to the indicators, so they're kept as float32
+    raw = np.array([
+        (b.open, b.close, b.high, b.low, b.second_offset, b.volume) for b in bars
+    ], dtype=np.float64).reshape(-1, 6)
+    cols = np.ascontiguousarray(raw.T)
+    prices = cols[:4].astype(np.float32)
+    return prices[0], prices[1], prices[2], prices[3], cols[4].astype(np.int64), cols[5].astype(np.int64)
+
+
 class GeneralStockPlotInfo:
     def __init__(self, entry_index: int, bars: List[Bar], news: List[News], annotations: List[Annotation]):
         self.entry_index = entry_index
+        self.version = next(DATA_VERSIONS)
         self.first_bar: Optional[Bar] = None
         self.bars = bars
         self.previous_bars: Optional[List[Bar]] = None
-        self.previous_opens: Optional[List[float]] = None
-        self.previous_closes: Optional[List[float]] = None
-        self.previous_highs: Optional[List[float]] = None
-        self.previous_lows: Optional[List[float]] = None
-        self.previous_times: Optional[List[int]] = None
-        self.previous_volumes: Optional[List[int]] = None
+        self.previous_opens: Optional[np.ndarray] = None
+        self.previous_closes: Optional[np.ndarray] = None
+        self.previous_highs: Optional[np.ndarray] = None
+        self.previous_lows: Optional[np.ndarray] = None
+        self.previous_times: Optional[np.ndarray] = None
+        self.previous_volumes: Optional[np.ndarray] = None
         self.news = news
         self.annotations = annotations
-        self.opens = [b.open for b in self.bars]
-        self.closes = [b.close for b in self.bars]
-        self.highs = [b.high for b in self.bars]
-        self.lows = [b.low for b in self.bars]
-        self.times = [datetime_to_second_offset(b.timestamp) for b in self.bars]
-        self.news_times = [datetime_to_second_offset(n.timestamp) for n in self.news]
-        self.volumes = [b.volume for b in self.bars]
+        self.opens, self.closes, self.highs, self.lows, self.times, self.volumes = _bars_to_soa(self.bars)
+        self.news_times = np.fromiter(
+            (datetime_to_second_offset(n.timestamp) for n in self.news), dtype=np.int64, count=len(self.news)
+        )
 
     def update_bars(self, bars: List[Bar]):
+        self.version = next(DATA_VERSIONS)
         self.bars = bars
-        self.opens = [b.open for b in self.bars]
-        self.closes = [b.close for b in self.bars]
-        self.highs = [b.high for b in self.bars]
-        self.lows = [b.low for b in self.bars]
-        self.times = [datetime_to_second_offset(b.timestamp) for b in self.bars]
-        self.volumes = [b.volume for b in self.bars]
+        self.opens, self.closes, self.highs, self.lows, self.times, self.volumes = _bars_to_soa(self.bars)
 
     def update_previous_bars(self, first_bar: Bar, bars: List[Bar]):
+        self.version = next(DATA_VERSIONS)
         self.first_bar = first_bar
         self.previous_bars = bars
-        self.previous_opens = [b.open for b in bars]
-        self.previous_closes = [b.close for b in bars]
-        self.previous_highs = [b.high for b in bars]
-        self.previous_lows = [b.low for b in bars]
-        self.previous_times = [datetime_to_second_offset(b.timestamp) for b in bars]
-        self.previous_volumes = [b.volume for b in bars]
+        (self.previous_opens, self.previous_closes, self.previous_highs, self.previous_lows,
+         self.previous_times, self.previous_volumes) = _bars_to_soa(bars)
+
+    def time_slice(self, start: float, stop: float) -> slice:
+        # times are sorted, so the bars within [start, stop] are a contiguous range
+        return slice(
+            int(np.searchsorted(self.times, start, side='left')),
+            int(np.searchsorted(self.times, stop, side='right'))
+        )
 
 
 class PlotStateInfo:
@@ -76,6 +92,37 @@ class PlotStateInfo:
 
 
 class StockPlotter(ABC):
+    def __init__(self):
+        # artists are kept between refreshes so they can be updated in place instead of recreated
+        self.artists: Dict[str, Artist] = {}
+
+    def clear_artists(self):
+        self.artists = {}
+
+    def update_line(self, ax: plt.Axes, key: str, x, y, **kwargs) -> Artist:
+        line = self.artists.get(key)
+        if line is None:
+            line, = ax.plot(x, y, **kwargs)
+            self.artists[key] = line
+        else:
+            line.set_data(x, y)
+            line.set_visible(True)
+        return line
+
+    def update_points(self, ax: plt.Axes, key: str, x, y, **kwargs) -> Artist:
+        points = self.artists.get(key)
+        if points is None:
+            points = ax.scatter(x, y, **kwargs)
+            self.artists[key] = points
+        else:
+            points.set_offsets(np.column_stack((np.atleast_1d(x), np.atleast_1d(y))))
+            points.set_visible(True)
+        return points
+
+    def hide_artist(self, key: str):
+        if key in self.artists:
+            self.artists[key].set_visible(False)
+
     @abstractmethod
     def plot(self, axes: StockAxesInfo, state: PlotStateInfo, data: GeneralStockPlotInfo):
         pass
@@ -12,6 +12,13 @@ DEVICE = (
     else "cpu"
 )
 
+# page-locked host memory lets the batches be copied to the gpu asynchronously
+PIN_MEMORY = DEVICE == "cuda"
+
+# mixed precision training, bf16 has the range of fp32 so only fp16 needs its loss scaled
+USE_AMP = DEVICE == "cuda"
+AMP_DTYPE = torch.bfloat16 if USE_AMP and torch.cuda.is_bf16_supported() else torch.float16
+
 USE_PERCENTS = True
 
 
@@ -1,6 +1,11 @@
+import pathlib
 from typing import List
 
+import torch
 from torch import nn as tnn
+from torch.ao.nn.quantized import dynamic as qdynamic
+
+from pystonks.supervised.training.definitions import INPUT_COUNT, HIDDEN_LAYER_DEF, OUTPUT_COUNT
 
 
 class TraderNeuralNetwork(tnn.Module):
@@ -23,3 +28,36 @@ class TraderNeuralNetwork(tnn.Module):
 
     def forward(self, x):
         return self.layers(x)
+
+
+def quantize_network(model: tnn.Module) -> tnn.Module:
+    # int8 weights for the linear layers, only runs on the cpu
+    return torch.ao.quantization.quantize_dynamic(model.cpu().eval(), {tnn.Linear}, dtype=torch.qint8)
+
+
+def is_quantized(model: tnn.Module) -> bool:
+    return any(isinstance(m, qdynamic.Linear) for m in model.modules())
+
+
+def freeze_network(model: tnn.Module) -> tnn.Module:
+    # scripted and frozen for inference only, freezing drops what autograd needs
+    try:
+        return torch.jit.freeze(torch.jit.script(model.eval()))
+    except Exception as e:
+        print(f'could not freeze the network, running it eagerly: {e}')
+        return model
+
+
+def save_network(model: tnn.Module, loc: pathlib.Path):
+    # only the weights are stored, compiled wrappers keep the real module in _orig_mod
+    torch.save(getattr(model, '_orig_mod', model).state_dict(), loc)
+
+
+def load_network(loc: pathlib.Path) -> tnn.Module:
+    # quantized copies and models saved before the weights only format are whole pickled modules
+    saved = torch.load(loc, map_location='cpu', weights_only=False)
+    if isinstance(saved, tnn.Module):
+        return saved
+    model = TraderNeuralNetwork(INPUT_COUNT, HIDDEN_LAYER_DEF, OUTPUT_COUNT)
+    model.load_state_dict(saved)
+    return model
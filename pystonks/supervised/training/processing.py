@@ -1,90 +1,152 @@
+import bisect
 import math
-from typing import List, Tuple
+from typing import Callable, Dict, List, Optional, Tuple
 
+import numpy as np
 import torch
 
 from pystonks.models import Bar
 from pystonks.supervised.annotations.models import Annotation, TradeActions
-from pystonks.utils.processing import datetime_to_second_offset, generate_percentages_since_previous_from_bars
+from pystonks.utils.jit import njit
 
 
-def flatten_bars(bars: List[Bar]) -> List[float]:
-    res = []
-    for b in bars:
-        res += [
-            float(datetime_to_second_offset(b.timestamp)),
-            b.open, b.close, b.high, b.low, float(b.volume)
-        ]
-    return res
+def flatten_bars(bars: List[Bar], dtype: np.dtype = np.float32) -> np.ndarray:
+    # (offset, open, close, high, low, volume) for each bar, back to back
+    return np.array([
+        (b.second_offset, b.open, b.close, b.high, b.low, b.volume) for b in bars
+    ], dtype=dtype).reshape(-1)
+
+
+@njit(cache=True)
+def _weave_kernel(window: np.ndarray, balance: float, shares: int,
+                  use_percents: bool, input_size: int) -> np.ndarray:
+    result = np.zeros(input_size, dtype=np.float32)
+    result[0] = balance
+    result[1] = shares
+
+    # the prices become percentages of the previous bar, which drops the first one
+    width = input_size - 2
+    k = 0
+    for i in range(1 if use_percents else 0, window.shape[0]):
+        for j in range(6):
+            if k >= width:
+                return result
+            v = window[i, j]
+            if use_percents and 1 <= j <= 4:
+                old = window[i - 1, j]
+                v = (v - old) / old if old != 0 else 0.
+            result[2 + k] = v
+            k += 1
+    return result
+
+
+def weave_input_data(balance: float, shares: int, use_percents: bool, input_size: int,
+                     window: np.ndarray) -> torch.Tensor:
+    # window is flatten_bars(bars, np.float64).reshape(-1, 6), so a whole day can be converted once and sliced
+    return torch.from_numpy(_weave_kernel(window, balance, shares, use_percents, input_size))
 
 
 def generate_input_data(balance: float, shares: int, use_percents: bool, input_size: int,
                         bars: List[Bar]) -> torch.Tensor:
-    result = [balance, float(shares)]
+    return weave_input_data(balance, shares, use_percents, input_size,
+                            flatten_bars(bars, np.float64).reshape(-1, 6))
+
+
+def collate_input_data(windows: List[np.ndarray], balances: List[float], shares: List[int],
+                       use_percents: bool, input_size: int) -> torch.Tensor:
+    # same layout as generate_input_data, but for a whole batch of flatten_bars(...).reshape(-1, 6) windows at once
+    width = input_size - 2
+    rows = -(-width // 6) + (1 if use_percents else 0)
+    count = len(windows)
+
+    stacked = np.zeros((count, rows, 6))
+    lengths = np.zeros(count, dtype=np.int64)
+    for i, w in enumerate(windows):
+        w = w[:rows]
+        stacked[i, :len(w)] = w
+        lengths[i] = len(w)
 
     if use_percents:
-        bars = generate_percentages_since_previous_from_bars(bars)
+        new, old = stacked[:, 1:], stacked[:, :-1]
+        values = new.copy()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values[:, :, 1:5] = np.where(old[:, :, 1:5] != 0, (new[:, :, 1:5] - old[:, :, 1:5]) / old[:, :, 1:5], 0)
+        # everything past the last bar of a window is padding
+        values[np.arange(rows - 1)[None, :] >= (lengths - 1)[:, None]] = 0
+        stacked = values
+
+    result = np.zeros((count, input_size), dtype=np.float32)
+    result[:, 0] = balances
+    result[:, 1] = shares
+    result[:, 2:] = stacked.reshape(count, -1)[:, :width]
+    return torch.from_numpy(result)
+
+
+def _simulate_buy_all(balance: float, shares: int, price: float) -> Tuple[float, int]:
+    bought = int(math.floor(balance / price)) if price != 0 else 0
+    return balance - bought * price, shares + bought
 
-    fb = flatten_bars(bars)
-    if len(fb) < input_size - 2:
-        diff = (input_size - 2) - len(fb)
-        fb += [0.]*diff
-    if len(fb) > input_size - 2:
-        fb = fb[:input_size - 2]
 
-    result += fb
+def _simulate_buy_half(balance: float, shares: int, price: float) -> Tuple[float, int]:
+    bought = int(math.floor((balance / 2) / price)) if price != 0 else 0
+    return balance - bought * price, shares + bought
 
-    return torch.tensor(result)
+
+def _simulate_sell_half(balance: float, shares: int, price: float) -> Tuple[float, int]:
+    sold = shares // 2
+    return balance + sold * price, shares - sold
+
+
+def _simulate_sell_all(balance: float, shares: int, price: float) -> Tuple[float, int]:
+    return balance + shares * price, 0
+
+
+def _simulate_hold(balance: float, shares: int, price: float) -> Tuple[float, int]:
+    # do nothing
+    return balance, shares
+
+
+SIMULATED_RESPONSES: Dict[TradeActions, Callable[[float, int, float], Tuple[float, int]]] = {
+    TradeActions.HOLD: _simulate_hold,
+    TradeActions.BUY_HALF: _simulate_buy_half,
+    TradeActions.BUY_ALL: _simulate_buy_all,
+    TradeActions.SELL_HALF: _simulate_sell_half,
+    TradeActions.SELL_ALL: _simulate_sell_all,
+}
 
 
 def handle_simulated_model_response(current_balance: float, current_shares: int,
                                     current_price: float, action: TradeActions) -> Tuple[float, int]:
-    if action == TradeActions.BUY_ALL:
-        shares = int(math.floor(current_balance / current_price)) if current_price != 0 else 0
-        cost = shares * current_price
-        current_shares += shares
-        current_balance -= cost
-    elif action == TradeActions.BUY_HALF:
-        h = current_balance / 2
-        hs = int(math.floor(h / current_price)) if current_price != 0 else 0
-        tc = hs * current_price
-        current_shares += hs
-        current_balance -= tc
-    elif action == TradeActions.SELL_HALF:
-        h = current_shares // 2
-        hc = h * current_price
-        current_shares -= h
-        current_balance += hc
-    elif action == TradeActions.SELL_ALL:
-        c = current_shares * current_price
-        current_shares = 0
-        current_balance += c
-    elif action == TradeActions.HOLD:
-        # do nothing
-        pass
-    else:
+    handler = SIMULATED_RESPONSES.get(action)
+    if handler is None:
         raise Exception(f'unrecognized action {action.name}({action.value})')
-
-    return current_balance, current_shares
+    return handler(current_balance, current_shares, current_price)
 
 
 def find_current_balance(initial_balance: float, bars: List[Bar], actions: List[Annotation]) -> Tuple[float, int]:
-    aindex = 0
     cb = initial_balance
     cs = 0
 
-    if len(actions) == 0:
-        return cb, cs
+    # both are in time order, so jump straight to the bar of each action instead of walking every bar
+    bindex = 0
+    for a in actions:
+        bindex = bisect.bisect_left(bars, a.timestamp, lo=bindex, key=lambda b: b.timestamp)
+        if bindex >= len(bars) or bars[bindex].timestamp != a.timestamp:
+            break
 
-    for b in bars:
-        if b.timestamp == actions[aindex].timestamp:
-            bc = b.close
-            act = actions[aindex].action
+        cb, cs = handle_simulated_model_response(cb, cs, bars[bindex].close, a.action)
+        bindex += 1
 
-            cb, cs = handle_simulated_model_response(cb, cs, bc, act)
+    return cb, cs
 
-            aindex += 1
-            if aindex >= len(actions):
-                break
 
+def replay_actions(initial_balance: float, fills: List[Tuple[TradeActions, Optional[float]]]) -> Tuple[float, int]:
+    # same as find_current_balance, but with each action already paired with the close of its bar,
+    # a missing close ends the replay like a missing bar does there
+    cb = initial_balance
+    cs = 0
+    for action, close in fills:
+        if close is None:
+            break
+        cb, cs = handle_simulated_model_response(cb, cs, close, action)
     return cb, cs
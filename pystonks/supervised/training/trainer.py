@@ -1,137 +1,329 @@
 import math
-from argparse import ArgumentParser
+from argparse import ArgumentParser, BooleanOptionalAction
 import datetime as dt
-from pathlib import Path
+import os
 import random as rng
-from typing import List, Tuple
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
 
+import numpy as np
 import torch
+import torch.distributed as dist
 from torch.optim import SGD
 from torch import nn
-from torch.utils.data import Dataset, DataLoader
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data import Dataset, DataLoader, DistributedSampler, Sampler
 
-from pystonks.apis.sql import SQL_TIME_FMT, SQL_DATE_FMT
+from pystonks.apis.sql import SQL_TIME_FMT, SQL_DATE_FMT, values_chunks
 from pystonks.market.filter import StaticFloatFilter
-from pystonks.models import Bar
 from pystonks.supervised.annotations.cluster import AnnotatorCluster
 from pystonks.supervised.annotations.models import TradeActions, Annotation
-from pystonks.supervised.training.definitions import DEVICE, INPUT_COUNT, HIDDEN_LAYER_DEF, OUTPUT_COUNT, USE_PERCENTS
-from pystonks.supervised.training.nn import TraderNeuralNetwork
-from pystonks.supervised.training.processing import flatten_bars, generate_input_data, find_current_balance
+from pystonks.supervised.training.definitions import DEVICE, INPUT_COUNT, HIDDEN_LAYER_DEF, OUTPUT_COUNT, USE_PERCENTS, \
+    PIN_MEMORY, USE_AMP, AMP_DTYPE
+from pystonks.supervised.training.nn import TraderNeuralNetwork, quantize_network, freeze_network, save_network, \
+    load_network
+from pystonks.supervised.training.processing import collate_input_data, replay_actions
 from pystonks.utils.config import read_config
 from pystonks.utils.processing import datetime_to_second_offset, generate_percentages_since_previous_from_bars
 
 TRAINER_VERSION = '1.1.4'
 
+# the samples are built from sqlite and python, workers overlap that with the model
+LOADER_WORKERS = min(8, (os.cpu_count() or 0) // 2)
+
 
 class TradingDataset(Dataset):
     def __init__(self, cluster: AnnotatorCluster, inputs: int, initial_balance: float = 100.):
         self.annotations = cluster
         self.inputs = inputs
         self.initial_balance = initial_balance
-        self.raw_anno_count = -1
+        # fetched once up front, indexing them with limit/offset per sample rescans the table every time
+        self.targets: List[Annotation] = self.annotations.retrieve_all_annotations()
         self.holds: List[Annotation] = []
+        # the window and balance of every symbol and day with a sample on it
+        self.day_samples: Dict[Tuple[str, str], Tuple[np.ndarray, float, int]] = {}
         self.create_hold_rows()
+        # sample indices grouped by symbol and day, used to batch the samples of a day together
+        self.days: Dict[Tuple[str, str], List[int]] = {}
+        for i in range(len(self)):
+            target = self.get_sample_target(i)
+            self.days.setdefault((target.symbol, target.timestamp.strftime(SQL_DATE_FMT)), []).append(i)
+        self.load_snapshot()
+
+    def __getstate__(self):
+        # the loader workers only read the snapshot, the cluster holds a sqlite connection and locks
+        # that can't be pickled when the workers are spawned
+        state = self.__dict__.copy()
+        state['annotations'] = None
+        return state
 
     def __len__(self):
         return self.get_raw_annotation_count() * 2
 
-    def __getitem__(self, item: int):
-        if item >= self.get_raw_annotation_count():
-            item -= self.get_raw_annotation_count()
-            target = self.holds[item]
-        else:
-            target = self.get_target_annotations(item)
+    def __getitem__(self, item: int) -> Tuple[np.ndarray, float, int, int]:
+        return self.__getitems__([item])[0]
 
-        bars = self.find_bar_window(target.symbol, target.timestamp)
-        annotations = self.find_action_window(target.symbol, target.timestamp)
-        cb, cs = find_current_balance(self.initial_balance, bars, annotations)
-        weaved = generate_input_data(cb, cs, USE_PERCENTS, self.inputs, bars)
-        return weaved, int(target.action.value)
+    def __getitems__(self, items: List[int]) -> List[Tuple[np.ndarray, float, int, int]]:
+        # the window and balance only depend on the day, the input tensors are built for the whole batch in collate
+        result = []
+        for item in items:
+            target = self.get_sample_target(item)
+            result.append((*self.find_day_sample(target.symbol, target.timestamp), int(target.action.value)))
+        return result
+
+    def collate(self, batch: List[Tuple[np.ndarray, float, int, int]]) -> Tuple[torch.Tensor, torch.Tensor]:
+        windows, balances, shares, actions = zip(*batch)
+        weaved = collate_input_data(list(windows), list(balances), list(shares), USE_PERCENTS, self.inputs)
+        return weaved, torch.tensor(actions, dtype=torch.long)
 
     def get_raw_annotation_count(self) -> int:
-        if self.raw_anno_count < 0:
-            self.raw_anno_count = self.annotations.count()
-        return self.raw_anno_count
+        return len(self.targets)
 
     def create_hold_rows(self):
         self.holds = []
-        rows = self.annotations.cache.custom_query(
-            'select symbol, timestamp from bars where '
-            '(symbol, timestamp) not in '
-            '(select symbol, timestamp from annotations) order by date(timestamp) asc, symbol asc, timestamp asc'
-        )
-        rrows = rng.sample(rows, self.get_raw_annotation_count())
+        # sampled by sqlite, the annotations primary key makes the anti join cheap
+        # and only the chosen rows are copied out
+        count = self.get_raw_annotation_count()
+        rrows = None
+        if is_main_process():
+            rrows = self.annotations.cache.custom_query(
+                'select b.symbol, b.timestamp from bars b '
+                'left join annotations a on a.symbol = b.symbol and a.timestamp = b.timestamp '
+                'where a.symbol is null order by random() limit ?',
+                params=(count,)
+            )
+        if dist.is_initialized():
+            # the distributed sampler splits one dataset between the ranks, so they all use the first rank's holds
+            shared = [rrows]
+            dist.broadcast_object_list(shared, src=0)
+            rrows = shared[0]
+        if len(rrows) < count:
+            raise Exception(f'only {len(rrows)} unannotated bars to use as holds, {count} are needed')
         self.holds = [Annotation(s, dt.datetime.fromisoformat(t), TradeActions.HOLD) for s, t in rrows]
 
-    def find_action_window(self, symbol: str, timestamp: dt.datetime) -> List[Annotation]:
-        return self.annotations.retrieve_all_annotations(symbol, timestamp)
-
-    def find_bar_window(self, symbol: str, date: dt.datetime) -> List[Bar]:
-        rows = self.annotations.cache.custom_query(
-            'select timestamp, open, close, high, low, volume from bars where symbol = ? and date(timestamp) = ? '
-            'order by timestamp',
-            params=(symbol, date.strftime(SQL_DATE_FMT))
-        )
-        return [Bar(symbol, dt.datetime.fromisoformat(t), o, c, h, l, v) for t, o, c, h, l, v in rows]
+    def load_snapshot(self):
+        # every day the samples use is read up front, after that sqlite is out of the training loop
+        self.day_samples = {}
+        keys = list(self.days)
+
+        windows: Dict[Tuple[str, str], list] = {}
+        fills: Dict[Tuple[str, str], List[Tuple[TradeActions, Optional[float]]]] = {}
+        for days, params in values_chunks(keys):
+            # the timestamps are isoformat text, so the seconds since midnight are cut straight out of them
+            # instead of parsing a datetime for every bar
+            for row in self.annotations.cache.custom_query(
+                'select symbol, date(timestamp), '
+                'cast(substr(timestamp, 12, 2) as integer) * 3600 + '
+                'cast(substr(timestamp, 15, 2) as integer) * 60 + '
+                'cast(substr(timestamp, 18, 2) as integer), open, close, high, low, volume '
+                f'from bars where (symbol, date(timestamp)) in {days} '
+                'order by symbol asc, timestamp asc',
+                params=params
+            ):
+                windows.setdefault((row[0], row[1]), []).append(row[2:])
+
+            # both tables store the timestamps with isoformat, so the actions join their bars on the text
+            for symbol, date, action, close in self.annotations.cache.custom_query(
+                'select a.symbol, date(a.timestamp), a.action, b.close from annotations a '
+                'left join bars b on b.symbol = a.symbol and b.timestamp = a.timestamp '
+                f'where (a.symbol, date(a.timestamp)) in {days} '
+                'order by a.symbol asc, a.timestamp asc',
+                params=params
+            ):
+                fills.setdefault((symbol, date), []).append((TradeActions[action], close))
+
+        for key in self.days:
+            window = np.array(windows.get(key, []), dtype=np.float64).reshape(-1, 6)
+            cb, cs = replay_actions(self.initial_balance, fills.get(key, []))
+            self.day_samples[key] = window, cb, cs
+
+    def find_day_sample(self, symbol: str, date: dt.datetime) -> Tuple[np.ndarray, float, int]:
+        return self.day_samples[(symbol, date.strftime(SQL_DATE_FMT))]
 
     def get_target_annotations(self, item: int) -> Annotation:
-        row = self.annotations.cache.custom_query(
-            'select * from annotations order by date(timestamp) asc, symbol asc, timestamp asc limit 1 offset ?',
-            (item,)
-        )[0]
-        return Annotation(row[0], dt.datetime.fromisoformat(row[1]), TradeActions[row[2]])
-
+        return self.targets[item]
 
-def training_loop(model: TraderNeuralNetwork, dataset: Dataset, batch_size: int, rate: float, epochs: int):
-    size = len(dataset)
-
-    dl = DataLoader(dataset, batch_size=batch_size, shuffle=True)
+    def get_sample_target(self, item: int) -> Annotation:
+        if item >= self.get_raw_annotation_count():
+            return self.holds[item - self.get_raw_annotation_count()]
+        return self.get_target_annotations(item)
+
+
+# shuffles the order of the days and the samples within them, then cuts the result into batches,
+# so a batch only spans a few days and their windows are shared
+class DayBatchSampler(Sampler[List[int]]):
+    def __init__(self, days: List[List[int]], batch_size: int, shuffle: bool = True, drop_last: bool = False):
+        self.days = days
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.count = sum(len(d) for d in days)
+
+    def __iter__(self):
+        order = list(self.days)
+        if self.shuffle:
+            rng.shuffle(order)
+        batch = []
+        for day in order:
+            if self.shuffle:
+                day = rng.sample(day, len(day))
+            for item in day:
+                batch.append(item)
+                if len(batch) == self.batch_size:
+                    yield batch
+                    batch = []
+        if len(batch) > 0 and not self.drop_last:
+            yield batch
+
+    def __len__(self) -> int:
+        if self.drop_last:
+            return self.count // self.batch_size
+        return -(-self.count // self.batch_size)
+
+
+def init_distributed() -> int:
+    # torchrun sets LOCAL_RANK, otherwise training stays in this process
+    if 'LOCAL_RANK' not in os.environ:
+        return -1
+    local_rank = int(os.environ['LOCAL_RANK'])
+    if DEVICE == 'cuda':
+        torch.cuda.set_device(local_rank)
+    dist.init_process_group(backend='nccl' if DEVICE == 'cuda' else 'gloo')
+    return local_rank
+
+
+def is_main_process() -> bool:
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+def create_loader(dataset: TradingDataset, batch_size: int, sampler: Optional[DistributedSampler] = None,
+                  drop_last: bool = False) -> DataLoader:
+    kwargs = {}
+    if LOADER_WORKERS > 0:
+        kwargs = {
+            'num_workers': LOADER_WORKERS,
+            'persistent_workers': True,
+            'prefetch_factor': 4,
+        }
+    if sampler is None:
+        return DataLoader(dataset, batch_sampler=DayBatchSampler(list(dataset.days.values()), batch_size,
+                                                                 drop_last=drop_last),
+                          collate_fn=dataset.collate, pin_memory=PIN_MEMORY, **kwargs)
+    return DataLoader(dataset, batch_size=batch_size, sampler=sampler, drop_last=drop_last,
+                      collate_fn=dataset.collate, pin_memory=PIN_MEMORY, **kwargs)
+
+
+# copies the next batch onto the gpu on a side stream while the current one is in use
+class CUDAPrefetcher:
+    def __init__(self, loader: DataLoader):
+        self.loader = loader
+        self.stream = torch.cuda.Stream()
+        self.it = None
+        self.batch = None
+
+    def preload(self):
+        try:
+            X, y = next(self.it)
+        except StopIteration:
+            self.batch = None
+            return
+        with torch.cuda.stream(self.stream):
+            self.batch = X.cuda(non_blocking=True), y.cuda(non_blocking=True)
+
+    def next(self) -> Optional[Tuple[torch.Tensor, torch.Tensor]]:
+        torch.cuda.current_stream().wait_stream(self.stream)
+        batch = self.batch
+        if batch is not None:
+            for t in batch:
+                t.record_stream(torch.cuda.current_stream())
+            self.preload()
+        return batch
+
+    def __iter__(self):
+        self.it = iter(self.loader)
+        self.preload()
+        return self
+
+    def __next__(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        batch = self.next()
+        if batch is None:
+            raise StopIteration
+        return batch
+
+    def __len__(self) -> int:
+        return len(self.loader)
+
+
+def device_batches(dl: DataLoader) -> Iterable[Tuple[torch.Tensor, torch.Tensor]]:
+    if DEVICE == 'cuda':
+        return CUDAPrefetcher(dl)
+    return ((X.to(DEVICE, non_blocking=PIN_MEMORY), y.to(DEVICE, non_blocking=PIN_MEMORY)) for X, y in dl)
+
+
+def training_loop(model: nn.Module, dataset: TradingDataset, batch_size: int, rate: float, epochs: int):
+    sampler = DistributedSampler(dataset, shuffle=True) if dist.is_initialized() else None
+    size = len(dataset) if sampler is None else len(sampler)
+
+    # every training step gets the same shape, unless there isn't even one full batch
+    dl = create_loader(dataset, batch_size, sampler, drop_last=size >= batch_size)
     loss_fn = nn.CrossEntropyLoss()
-    optim = SGD(model.parameters(), lr=rate)
+    # a single multi tensor kernel for the whole update, instead of one per parameter
+    optim = SGD(model.parameters(), lr=rate, fused=True) if DEVICE == 'cuda' else \
+        SGD(model.parameters(), lr=rate, foreach=True)
+    scaler = torch.amp.GradScaler('cuda', enabled=USE_AMP and AMP_DTYPE == torch.float16)
 
     for epoch in range(epochs):
+        if sampler is not None:
+            sampler.set_epoch(epoch)
         start = dt.datetime.now()
-        for batch, (X, y) in enumerate(dl):
-            X = X.to(DEVICE)
-            y = y.to(DEVICE)
+        for batch, (X, y) in enumerate(device_batches(dl)):
+            with torch.autocast(device_type='cuda', dtype=AMP_DTYPE, enabled=USE_AMP):
+                pred = model(X)
+                loss = loss_fn(pred, y)
 
-            pred = model(X)
-            loss = loss_fn(pred, y)
-
-            loss.backward()
-            optim.step()
-            optim.zero_grad()
+            scaler.scale(loss).backward()
+            scaler.step(optim)
+            scaler.update()
+            optim.zero_grad(set_to_none=True)
 
             if batch % 10 == 0:
+                loss = loss.detach()
+                if sampler is not None:
+                    # every rank reaches the same batches, so the mean over the ranks can be reported
+                    dist.all_reduce(loss, op=dist.ReduceOp.SUM)
+                    loss /= dist.get_world_size()
                 loss, current = loss.item(), batch * batch_size + len(X)
-                print(f"loss: {loss:>7f}  [{current:>5d}/{size:>5d}]")
-        print(f"Epoch {epoch}: loss: {loss:>7f}  [{current:>5d}/{size:>5d}] "
-              f"@ {(dt.datetime.now() - start).total_seconds()} sec/epoch")
+                if is_main_process():
+                    print(f"loss: {loss:>7f}  [{current:>5d}/{size:>5d}]")
+        if is_main_process():
+            print(f"Epoch {epoch}: loss: {loss:>7f}  [{current:>5d}/{size:>5d}] "
+                  f"@ {(dt.datetime.now() - start).total_seconds()} sec/epoch")
 
 
-def testing_loop(model: TraderNeuralNetwork, dataset: Dataset, batch_size: int):
-    dl = DataLoader(dataset, batch_size=batch_size, shuffle=True)
+def testing_loop(model: nn.Module, dataset: TradingDataset, batch_size: int):
+    dl = create_loader(dataset, batch_size)
     loss_fn = nn.CrossEntropyLoss()
 
     # Set the model to evaluation mode - important for batch normalization and dropout layers
     # Unnecessary in this situation but added for best practices
     model.eval()
+    frozen = freeze_network(model)
     size = len(dl.dataset)
     num_batches = len(dl)
-    test_loss, correct = 0, 0
+    # kept on the device and only read back once at the end, .item() syncs with the gpu
+    test_loss = torch.zeros((), device=DEVICE)
+    correct = torch.zeros((), dtype=torch.long, device=DEVICE)
 
     # Evaluating the model with torch.no_grad() ensures that no gradients are computed during test mode
     # also serves to reduce unnecessary gradient computations and memory usage for tensors with requires_grad=True
     with torch.no_grad():
-        for X, y in dl:
-            y = y.to(DEVICE)
-            pred = model(X.to(DEVICE))
-            test_loss += loss_fn(pred, y).item()
-            correct += (pred.argmax(1) == y).type(torch.float).sum().item()
-
-    test_loss /= num_batches
-    correct /= size
+        for X, y in device_batches(dl):
+            pred = frozen(X)
+            test_loss += loss_fn(pred, y)
+            correct += (pred.argmax(1) == y).sum()
+
+    test_loss = test_loss.item() / num_batches
+    correct = correct.item() / size
     print(f"Test Error: \n Accuracy: {(100 * correct):>0.1f}%, Avg loss: {test_loss:>8f} \n")
 
 
@@ -147,12 +339,20 @@ if __name__ == '__main__':
     ap.add_argument('--rate', type=float, default=0.000001, help='the learning rate to use during training')
     ap.add_argument('-e', '--epochs', type=int, default=50,
                     help='the number of training dataset iterations')
+    ap.add_argument('--quantized-out', type=Path, default=None,
+                    help='if given, an int8 quantized copy of the trained model for cpu inference is saved here')
+    ap.add_argument('--compile', action=BooleanOptionalAction, default=DEVICE == 'cuda',
+                    help='compiles the model with torch.compile before training, fusing the linear and relu layers, '
+                         'on by default when training on cuda')
     args = ap.parse_args()
 
     if args.version:
         print(f'Trainer Version: v{TRAINER_VERSION}')
         exit(0)
 
+    if args.batch % 8 != 0:
+        print(f'warning: a batch size of {args.batch} is not a multiple of 8, which the tensor cores work best with')
+
     print(f'Pytorch using device: {DEVICE}')
     print(f'Using model with {INPUT_COUNT} inputs')
 
@@ -160,13 +360,22 @@ if __name__ == '__main__':
 
     if args.reuse and args.out.exists():
         print('loading saved model...')
-        model = torch.load(args.out)
+        model = load_network(args.out)
     else:
         model = TraderNeuralNetwork(INPUT_COUNT, HIDDEN_LAYER_DEF, OUTPUT_COUNT)
 
+    local_rank = init_distributed()
+
     model = model.to(DEVICE)
     print(model)
 
+    # the wrappers share their parameters with the model, so the plain module is what gets saved
+    runner = model
+    if local_rank >= 0:
+        runner = DDP(runner, device_ids=[local_rank] if DEVICE == 'cuda' else None)
+    if args.compile:
+        runner = torch.compile(runner, mode='reduce-overhead')
+
     ds = TradingDataset(
         AnnotatorCluster(
             config.db_location,
@@ -178,6 +387,11 @@ if __name__ == '__main__':
         INPUT_COUNT
     )
 
-    training_loop(model, ds, args.batch, args.rate, args.epochs)
-    testing_loop(model, ds, args.batch)
-    torch.save(model, args.out)
+    training_loop(runner, ds, args.batch, args.rate, args.epochs)
+    if is_main_process():
+        testing_loop(model, ds, args.batch)
+        save_network(model, args.out)
+        if args.quantized_out is not None:
+            torch.save(quantize_network(model), args.quantized_out)
+    if dist.is_initialized():
+        dist.destroy_process_group()
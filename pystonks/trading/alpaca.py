@@ -1,21 +1,31 @@
-import time
 import datetime as dt
-from typing import Optional, List
+from typing import Optional, List, Dict
+from itertools import chain
+from collections import OrderedDict
 
 from alpaca.data import TimeFrame, StockHistoricalDataClient, StockBarsRequest, \
     StockTradesRequest, StockQuotesRequest, StockLatestQuoteRequest, NewsRequest
 from alpaca.data.historical.news import NewsClient
 from alpaca.trading import Position, TradingClient, LimitOrderRequest, OrderSide, TimeInForce, GetCalendarRequest
-from alpaca.common import Sort, APIError
+from alpaca.common import Sort
 
 from pystonks.models import Bar, HistoricalQuote, Quote, Trade, News
 
 from pystonks.facades import TradingAPI, MarketDataAPI, NewsDataAPI
-from pystonks.utils.processing import process_interval, find_bars, timeframe_to_delta, truncate_datetime
-from pystonks.apis.sql import SQL_DATE_FMT
+from pystonks.utils.processing import process_interval, process_interval_ranges, find_bars, timeframe_to_delta, \
+    truncate_datetime
+from pystonks.apis.sql import sql_date
 from pystonks.utils.structures.caching import CacheAPI, CachedClass
+from pystonks.utils.structures.rate import TokenBucket
 
 RATE_LIMIT = 60. / 200.
+# historical ranges fetched at once, they all share the rate limit
+FETCH_WORKERS = 8
+# how long the open positions are trusted before asking alpaca again
+POSITIONS_TTL = dt.timedelta(seconds=1)
+
+# built days of bars kept in memory, across every symbol and bucket size
+BAR_DAY_CACHE_SIZE = 1024
 
 
 class AlpacaTrader(CachedClass, MarketDataAPI, TradingAPI, NewsDataAPI):
@@ -27,7 +37,9 @@ class AlpacaTrader(CachedClass, MarketDataAPI, TradingAPI, NewsDataAPI):
         self.mdclient: Optional[StockHistoricalDataClient] = None
         self.tclient: Optional[TradingClient] = None
         self.nclient: Optional[NewsClient] = None
-        self.last_req = None
+        self.bucket = TokenBucket(1 / RATE_LIMIT)
+        self.positions: Optional[Dict[str, Position]] = None
+        self.positions_time: Optional[dt.datetime] = None
         self.connect()
 
     def setup_tables(self):
@@ -67,6 +79,14 @@ class AlpacaTrader(CachedClass, MarketDataAPI, TradingAPI, NewsDataAPI):
                 f'{dp}_date_processed',
                 'symbol text, date text, primary key (symbol, date)'
             )
+        # the loaders select whole days, the primary keys can't be used for date(timestamp)
+        for tbl, column in [
+            ('news', 'updated_at'), ('bars', 'timestamp'), ('quotes', 'timestamp'), ('trades', 'timestamp')
+        ]:
+            self.db.custom_nr_query(
+                f'create index if not exists idx_{tbl}_symbol_date on {tbl}(symbol, date({column}))'
+            )
+        self.db.custom_nr_query('pragma optimize=0x10002', commit=True)
 
     def connect(self):
         if self.mdclient is None or self.tclient is None or self.nclient is None:
@@ -76,33 +96,37 @@ class AlpacaTrader(CachedClass, MarketDataAPI, TradingAPI, NewsDataAPI):
 
     def handle_request(self):
         self.connect()
-        if self.last_req is not None and (dt.datetime.now() - self.last_req).total_seconds() < RATE_LIMIT:
-            diff = RATE_LIMIT - (dt.datetime.now() - self.last_req).total_seconds()
-            time.sleep(diff)
-        self.last_req = dt.datetime.now()
+        self.bucket.take()
 
     def check_exists(self, tbl_pre: str, symbol: str, date: dt.datetime) -> bool:
         return self.cache_check(
             f'{tbl_pre}_date_processed',
             condition='symbol = ? and date = ?',
-            params=(symbol, date.strftime(SQL_DATE_FMT))
+            params=(symbol, sql_date(date))
         )
 
     def save_exists(self, tbl_pre: str, symbol: str, date: dt.datetime):
         self.cache_save(
             f'{tbl_pre}_date_processed',
-            params=(symbol, date.strftime(SQL_DATE_FMT))
+            params=(symbol, sql_date(date))
         )
 
+    def save_exists_many(self, tbl_pre: str, symbol: str, dates: List[dt.datetime]):
+        if len(dates) > 0:
+            self.cache_save_many(
+                f'{tbl_pre}_date_processed',
+                [(symbol, sql_date(d)) for d in dates]
+            )
+
     def historical_news(self, symbol: str, start: dt.datetime, dur: dt.timedelta) -> List[News]:
         def checker(date: dt.datetime) -> bool:
             return self.check_exists('news', symbol, date)
 
-        def fetcher(date: dt.datetime) -> List[News]:
+        def fetcher(begin: dt.datetime, end: dt.datetime) -> List[News]:
             self.handle_request()
             ns = self.nclient.get_news(NewsRequest(
-                start=date,
-                end=date + dt.timedelta(days=1),
+                start=begin,
+                end=end,
                 symbols=symbol,
                 include_content=False,
                 include_contentless=False
@@ -111,16 +135,17 @@ class AlpacaTrader(CachedClass, MarketDataAPI, TradingAPI, NewsDataAPI):
 
         def loader(date: dt.datetime) -> List[News]:
             rows = self.cache_lookup('news', condition='symbol = ? and date(updated_at) = ?',
-                                     params=(symbol, date.strftime(SQL_DATE_FMT)))
+                                     params=(symbol, sql_date(date)))
             return [
                 News(symbol, dt.datetime.fromisoformat(ts), nid, a, h, u, dt.datetime.fromisoformat(ua))
                 for nid, _, ts, ua, a, h, u in rows
             ]
 
         news_params = []
+        processed = []
 
         def saver(date: dt.datetime, rows: List[News]):
-            self.save_exists('news', symbol, date)
+            processed.append(date)
             for param in [
                 (
                     n.news_id, symbol,
@@ -132,15 +157,15 @@ class AlpacaTrader(CachedClass, MarketDataAPI, TradingAPI, NewsDataAPI):
             ]:
                 news_params.append(param)
 
-        collated = process_interval(truncate_datetime(start), dur, fetcher, loader, checker, saver)
+        collated = process_interval_ranges(truncate_datetime(start), dur, fetcher, loader, checker, saver,
+                                           lambda n: n.timestamp, workers=FETCH_WORKERS)
 
         if len(news_params) > 0:
             self.cache_save_many('news', news_params)
+        # the days are only marked once their rows are in
+        self.save_exists_many('news', symbol, processed)
 
-        result = []
-        for c in collated:
-            result += c
-        return result
+        return list(chain.from_iterable(collated))
 
     def news(self, symbol: str) -> List[News]:
         self.handle_request()
@@ -157,28 +182,29 @@ class AlpacaTrader(CachedClass, MarketDataAPI, TradingAPI, NewsDataAPI):
         def checker(date: dt.datetime) -> bool:
             return self.check_exists('bars', symbol, date)
 
-        def fetcher(date: dt.datetime) -> List[Bar]:
+        def fetcher(begin: dt.datetime, end: dt.datetime) -> List[Bar]:
             self.handle_request()
             bs = self.mdclient.get_stock_bars(StockBarsRequest(
                 symbol_or_symbols=symbol,
                 timeframe=buckets,
-                start=date,
-                end=date + dt.timedelta(days=1)
+                start=begin,
+                end=end
             )).data[symbol]
             return [Bar(symbol, b.timestamp, b.open, b.close, b.high, b.low, int(b.volume)) for b in bs]
 
         def loader(date: dt.datetime) -> List[Bar]:
             rows = self.cache_lookup('bars', condition='symbol = ? and date(timestamp) = ?',
-                                     params=(symbol, date.strftime(SQL_DATE_FMT)))
+                                     params=(symbol, sql_date(date)))
             return [
                 Bar(symbol, dt.datetime.fromisoformat(ts), op, cl, h, l, vol)
                 for _, ts, op, cl, h, l, vol in rows
             ]
 
         bar_params = []
+        processed = []
 
         def saver(date: dt.datetime, rows: List[Bar]):
-            self.save_exists('bars', symbol, date)
+            processed.append(date)
             for param in [
                 (
                     symbol,
@@ -189,15 +215,14 @@ class AlpacaTrader(CachedClass, MarketDataAPI, TradingAPI, NewsDataAPI):
             ]:
                 bar_params.append(param)
 
-        collated = process_interval(truncate_datetime(start), dur, fetcher, loader, checker, saver)
+        collated = process_interval_ranges(truncate_datetime(start), dur, fetcher, loader, checker, saver,
+                                           lambda b: b.timestamp, workers=FETCH_WORKERS)
 
         if len(bar_params) > 0:
             self.cache_save_many('bars', bar_params)
+        self.save_exists_many('bars', symbol, processed)
 
-        result = []
-        for c in collated:
-            result += c
-        return result
+        return list(chain.from_iterable(collated))
 
     def bars(self, symbol: str, buckets: TimeFrame = TimeFrame.Minute) -> List[Bar]:
         self.handle_request()
@@ -209,6 +234,7 @@ class AlpacaTrader(CachedClass, MarketDataAPI, TradingAPI, NewsDataAPI):
 
     def buy(self, symbol: str, count: int, price: float):
         self.handle_request()
+        self.invalidate_positions()
         self.tclient.submit_order(LimitOrderRequest(
             symbol=symbol,
             qty=count,
@@ -219,6 +245,7 @@ class AlpacaTrader(CachedClass, MarketDataAPI, TradingAPI, NewsDataAPI):
 
     def sell(self, symbol: str, count: int, price: float):
         self.handle_request()
+        self.invalidate_positions()
         self.tclient.submit_order(LimitOrderRequest(
             symbol=symbol,
             qty=count,
@@ -229,18 +256,19 @@ class AlpacaTrader(CachedClass, MarketDataAPI, TradingAPI, NewsDataAPI):
 
     def cancel_all(self):
         self.handle_request()
+        self.invalidate_positions()
         self.tclient.cancel_orders()
 
     def historical_quotes(self, symbol: str, start: dt.datetime, dur: dt.timedelta) -> List[HistoricalQuote]:
         def checker(date: dt.datetime) -> bool:
             return self.check_exists('quotes', symbol, date)
 
-        def fetcher(date: dt.datetime) -> List[HistoricalQuote]:
+        def fetcher(begin: dt.datetime, end: dt.datetime) -> List[HistoricalQuote]:
             self.handle_request()
             qs = self.mdclient.get_stock_quotes(StockQuotesRequest(
                 symbol_or_symbols=symbol,
-                start=date,
-                end=date + dt.timedelta(days=1)
+                start=begin,
+                end=end
             )).data[symbol]
             return [
                 HistoricalQuote(
@@ -252,15 +280,18 @@ class AlpacaTrader(CachedClass, MarketDataAPI, TradingAPI, NewsDataAPI):
 
         def loader(date: dt.datetime) -> List[HistoricalQuote]:
             rows = self.cache_lookup('quotes', condition='symbol = ? and date(timestamp) = ?',
-                                           params=(symbol, date.strftime(SQL_DATE_FMT)))
+                                           params=(symbol, sql_date(date)))
             return [
                 HistoricalQuote(symbol, dt.datetime.fromisoformat(ts), aex, asz, ap, bex, bs, bp)
                 for _, ts, aex, asz, ap, bex, bs, bp in rows
             ]
 
+        params = []
+        processed = []
+
         def saver(date: dt.datetime, rows: List[HistoricalQuote]):
-            self.save_exists('quotes', symbol, date)
-            params = [
+            processed.append(date)
+            params.extend(
                 (
                     symbol,
                     q.timestamp.isoformat(),
@@ -268,15 +299,16 @@ class AlpacaTrader(CachedClass, MarketDataAPI, TradingAPI, NewsDataAPI):
                     q.bid_exchange, q.bid_size, q.bid_price
                 )
                 for q in rows
-            ]
-            if len(params) > 0:
-                self.cache_save_many('quotes', params)
+            )
+
+        collated = process_interval_ranges(truncate_datetime(start), dur, fetcher, loader, checker, saver,
+                                           lambda q: q.timestamp, workers=FETCH_WORKERS)
+
+        if len(params) > 0:
+            self.cache_save_many('quotes', params)
+        self.save_exists_many('quotes', symbol, processed)
 
-        collated = process_interval(truncate_datetime(start), dur, fetcher, loader, checker, saver)
-        result = []
-        for c in collated:
-            result += c
-        return result
+        return list(chain.from_iterable(collated))
 
     def quotes(self, symbol: str) -> Quote:
         self.handle_request()
@@ -296,12 +328,20 @@ class AlpacaTrader(CachedClass, MarketDataAPI, TradingAPI, NewsDataAPI):
         acct = self.tclient.get_account()
         return float(acct.cash) if acct.cash is not None else 0.
 
+    def invalidate_positions(self):
+        self.positions = None
+
+    def open_positions(self) -> Dict[str, Position]:
+        # one request for every position, instead of one per symbol that raises when there isn't one
+        if self.positions is None or dt.datetime.now() - self.positions_time > POSITIONS_TTL:
+            self.handle_request()
+            self.positions = {p.symbol: p for p in self.tclient.get_all_positions()}
+            self.positions_time = dt.datetime.now()
+        return self.positions
+
     def shares(self, symbol: str) -> int:
-        try:
-            position = self.position(symbol)
-            return int(position.qty_available)
-        except APIError:
-            return 0
+        position = self.open_positions().get(symbol)
+        return int(position.qty_available) if position is not None else 0
 
     def position(self, symbol: str) -> Position:
         self.handle_request()
@@ -311,12 +351,12 @@ class AlpacaTrader(CachedClass, MarketDataAPI, TradingAPI, NewsDataAPI):
         def checker(date: dt.datetime) -> bool:
             return self.check_exists('trades', symbol, date)
 
-        def fetcher(date: dt.datetime) -> List[Trade]:
+        def fetcher(begin: dt.datetime, end: dt.datetime) -> List[Trade]:
             self.handle_request()
             ts = self.mdclient.get_stock_trades(StockTradesRequest(
                 symbol_or_symbols=symbol,
-                start=date,
-                end=date + dt.timedelta(days=1),
+                start=begin,
+                end=end,
                 sort=Sort.DESC
             )).data[symbol]
             return [
@@ -329,30 +369,34 @@ class AlpacaTrader(CachedClass, MarketDataAPI, TradingAPI, NewsDataAPI):
 
         def loader(date: dt.datetime) -> List[Trade]:
             rows = self.cache_lookup('trades', condition='symbol = ? and date(timestamp) = ?',
-                                     params=(symbol, date.strftime(SQL_DATE_FMT)))
+                                     params=(symbol, sql_date(date)))
             return [
                 Trade(symbol, dt.datetime.fromisoformat(ts), ex, sz, p)
                 for _, ts, ex, sz, p in rows
             ]
 
+        params = []
+        processed = []
+
         def saver(date: dt.datetime, rows: List[Trade]):
-            self.save_exists('trades', symbol, date)
-            params = [
+            processed.append(date)
+            params.extend(
                 (
                     symbol,
                     t.timestamp.isoformat(),
                     t.exchange, t.count, t.price
                 )
                 for t in rows
-            ]
-            if len(params) > 0:
-                self.cache_save_many('trades', params)
+            )
 
-        collated = process_interval(truncate_datetime(start), dur, fetcher, loader, checker, saver)
-        result = []
-        for c in collated:
-            result += c
-        return result
+        collated = process_interval_ranges(truncate_datetime(start), dur, fetcher, loader, checker, saver,
+                                           lambda t: t.timestamp, workers=FETCH_WORKERS)
+
+        if len(params) > 0:
+            self.cache_save_many('trades', params)
+        self.save_exists_many('trades', symbol, processed)
+
+        return list(chain.from_iterable(collated))
 
     def trades(self, symbol: str) -> List[Trade]:
         self.handle_request()
@@ -376,10 +420,18 @@ class AlpacaTrader(CachedClass, MarketDataAPI, TradingAPI, NewsDataAPI):
             start=(date - dt.timedelta(days=1)).date(),
             end=(date + dt.timedelta(days=1)).date(),
         ))
-        return any([c.date == date.date() for c in cal])
+        return any(c.date == date.date() for c in cal)
 
 
 class AlpacaTraderManualBars(AlpacaTrader):
+    def __init__(self, api_key: str, api_secret: str, paper: bool, cache: CacheAPI):
+        super().__init__(api_key, api_secret, paper, cache)
+        # days of bars already built this session, keyed by symbol, bucket size and day
+        self.bar_days: OrderedDict = OrderedDict()
+
+    def clear_cache(self):
+        self.bar_days.clear()
+
     def historical_bars(self, symbol: str,
                         start: dt.datetime, dur: dt.timedelta,
                         buckets: TimeFrame = TimeFrame.Minute) -> List[Bar]:
@@ -392,16 +444,17 @@ class AlpacaTraderManualBars(AlpacaTrader):
 
         def loader(date: dt.datetime) -> List[Bar]:
             rows = self.cache_lookup('bars', condition='symbol = ? and date(timestamp) = ?',
-                                     params=(symbol, date.strftime(SQL_DATE_FMT)))
+                                     params=(symbol, sql_date(date)))
             return [
                 Bar(symbol, dt.datetime.fromisoformat(ts), op, cl, h, l, vol)
                 for _, ts, op, cl, h, l, vol in rows
             ]
 
         bar_params = []
+        processed = []
 
         def saver(date: dt.datetime, rows: List[Bar]):
-            self.save_exists('bars', symbol, date)
+            processed.append(date)
             for param in [
                 (
                         symbol,
@@ -412,15 +465,15 @@ class AlpacaTraderManualBars(AlpacaTrader):
             ]:
                 bar_params.append(param)
 
-        collated = process_interval(truncate_datetime(start), dur, fetcher, loader, checker, saver)
+        collated = process_interval(truncate_datetime(start), dur, fetcher, loader, checker, saver,
+                                    cache=self.bar_days, cache_size=BAR_DAY_CACHE_SIZE,
+                                    cache_key=(symbol, str(buckets)))
 
         if len(bar_params) > 0:
             self.cache_save_many('bars', bar_params)
+        self.save_exists_many('bars', symbol, processed)
 
-        result = []
-        for c in collated:
-            result += c
-        return result
+        return list(chain.from_iterable(collated))
 
     def bars(self, symbol: str, buckets: TimeFrame = TimeFrame.Minute) -> List[Bar]:
         trades = self.trades(symbol)
@@ -1,16 +1,33 @@
 import datetime as dt
 import random as rng
-from typing import List, Any
+from typing import List, Dict, Tuple, Optional
 
 from alpaca.data import TimeFrame
+import numpy as np
 
-from pystonks.apis.sql import SQL_DATE_FMT
+from pystonks.apis.sql import SQL_DATE_FMT, sql_date, values_chunks
 from pystonks.facades import MarketDataAPI, TradingAPI, HistoricalMarketDataAPI
 from pystonks.models import News, Bar, HistoricalQuote, Trade
-from pystonks.utils.processing import process_interval, truncate_datetime
+from pystonks.utils.processing import interval_days, truncate_datetime
 from pystonks.utils.structures.caching import CacheAPI, ReadOnlyCacheAPI, CachedClass, ReadOnlyCachedClass
 
 
+# the trader's bookkeeping as a flat array, so the jitted simulations can update it without the object
+TRADER_STATE = ['cash', 'owned', 'buys', 'sells', 'mistakes', 'bottoms', 'entries', 'exits', 'cancels']
+STATE_CASH, STATE_OWNED, STATE_BUYS, STATE_SELLS, STATE_MISTAKES, STATE_BOTTOMS, STATE_ENTRIES, STATE_EXITS, \
+    STATE_CANCELS = range(len(TRADER_STATE))
+
+
+def state_property(index: int, kind: type) -> property:
+    def getter(self):
+        return kind(self.state[index])
+
+    def setter(self, value):
+        self.state[index] = value
+
+    return property(getter, setter)
+
+
 class SimulationResults:
     def __init__(self):
         self.total_profit = 0.
@@ -24,67 +41,101 @@ class SimulationResults:
         self.holds = 0
 
 
-def default_empty_saver(date: dt.datetime, rows: List[Any]):
-    pass
-
-
-def default_empty_fetcher(date: dt.datetime) -> List[Any]:
-    raise Exception('tried to fetch data in read only trader')
-
-
 class SimulatedTrader(ReadOnlyCachedClass, HistoricalMarketDataAPI, TradingAPI):
+    cash = state_property(STATE_CASH, float)
+    owned = state_property(STATE_OWNED, int)
+    buys = state_property(STATE_BUYS, int)
+    sells = state_property(STATE_SELLS, int)
+    mistakes = state_property(STATE_MISTAKES, int)
+    bottoms = state_property(STATE_BOTTOMS, int)
+    entries = state_property(STATE_ENTRIES, int)
+    exits = state_property(STATE_EXITS, int)
+    cancels = state_property(STATE_CANCELS, int)
+
     def __init__(self, cash: float, api_key: str, api_secret: str, paper: bool, cache: ReadOnlyCacheAPI):
         super().__init__(cache)
         self.api_key = api_key
         self.api_secret = api_secret
         self.paper = paper
         self.init_cash = cash
-        self.cash = cash
-        self.owned = 0
-        self.buys = 0
-        self.sells = 0
-        self.mistakes = 0
-        self.bottoms = 0
-        self.entries = 0
-        self.exits = 0
-        self.cancels = 0
+        self.state = np.zeros(len(TRADER_STATE), dtype=np.float64)
+        self.state[STATE_CASH] = cash
+        self.symbol_dates: Optional[Dict[str, List[dt.datetime]]] = None
 
     def check_exists(self, tbl_pre: str, symbol: str, date: dt.datetime) -> bool:
         return self.cache_check(
             f'{tbl_pre}_date_processed',
             condition='symbol = ? and date = ?',
-            params=(symbol, date.strftime(SQL_DATE_FMT))
+            params=(symbol, sql_date(date))
         )
 
+    def lookup_interval(self, tbl: str, symbol: str, start: dt.datetime, dur: dt.timedelta,
+                        date_column: str = 'timestamp', order: str = 'timestamp asc') -> List[tuple]:
+        # every day has to be cached already, so the coverage is checked and the rows loaded with one query each
+        days = interval_days(truncate_datetime(start), dur)
+        if len(days) == 0:
+            return []
+        first, last = sql_date(days[0]), sql_date(days[-1])
+
+        processed = {
+            r[0] for r in self.cache_lookup(f'{tbl}_date_processed', columns='date',
+                                            condition='symbol = ? and date >= ? and date <= ?',
+                                            params=(symbol, first, last))
+        }
+        if any(sql_date(d) not in processed for d in days):
+            raise Exception('tried to fetch data in read only trader')
+
+        return self.cache_lookup(tbl, condition=f'symbol = ? and date({date_column}) >= ? and date({date_column}) <= ?',
+                                 extras=f'order by date({date_column}) asc, {order}', params=(symbol, first, last))
+
     def get_cached_symbols(self) -> List[str]:
-        rows = self.cache_lookup('bars_date_processed', columns='distinct symbol')
-        return [s[0] for s in rows]
+        return list(self.get_cached_symbol_dates())
 
     def get_symbol_dates(self, symbol: str) -> List[dt.datetime]:
-        rows = self.cache_lookup('bars_date_processed', columns='distinct date',
-                                 condition='symbol = ?', params=(symbol,))
-        return [dt.datetime.strptime(r[0], SQL_DATE_FMT) for r in rows]
+        return self.get_cached_symbol_dates().get(symbol, [])
+
+    def get_cached_symbol_dates(self) -> Dict[str, List[dt.datetime]]:
+        # every symbol with the days it has bars for, the cache is read only so it's only queried once
+        if self.symbol_dates is None:
+            self.symbol_dates = {}
+            for symbol, date in self.cache_lookup('bars_date_processed', columns='symbol, date'):
+                self.symbol_dates.setdefault(symbol, []).append(dt.datetime.strptime(date, SQL_DATE_FMT))
+        return self.symbol_dates
+
+    def historical_bar_arrays_for_days(self, days: List[Tuple[str, dt.datetime]]) -> Dict[Tuple[str, str], np.ndarray]:
+        # the bars of many symbol and day pairs, keyed by (symbol, sql date)
+        # each day is a (offset, open, close, high, low, volume) array so the simulator never has to build bar objects
+        keys = list({(symbol, sql_date(d)) for symbol, d in days})
+        if len(keys) == 0:
+            return {}
+        rows = []
+        for days_values, params in values_chunks(keys):
+            rows.extend(self.db.custom_query(
+                'select symbol, date(timestamp), '
+                'cast(substr(timestamp, 12, 2) as integer) * 3600 + cast(substr(timestamp, 15, 2) as integer) * 60 + '
+                'cast(substr(timestamp, 18, 2) as integer), '
+                'open, close, high, low, volume from bars '
+                f'where (symbol, date(timestamp)) in {days_values} '
+                'order by symbol asc, timestamp asc',
+                params=params
+            ))
+        grouped = {k: [] for k in keys}
+        for r in rows:
+            grouped[(r[0], r[1])].append(r[2:])
+        return {k: np.array(v, dtype=np.float64).reshape(-1, 6) for k, v in grouped.items()}
 
     def reset(self):
-        self.cash = self.init_cash
-        self.owned = 0
-        self.buys = 0
-        self.sells = 0
-        self.mistakes = 0
-        self.bottoms = 0
-        self.entries = 0
-        self.exits = 0
-        self.cancels = 0
+        self.state.fill(0)
+        self.state[STATE_CASH] = self.init_cash
+
+    def get_state(self) -> np.ndarray:
+        # the live array, the jitted simulations update the trader in place
+        return self.state
 
     def get_results(self) -> SimulationResults:
         res = SimulationResults()
-        res.buys = self.buys
-        res.sells = self.sells
-        res.mistakes = self.mistakes
-        res.bottoms = self.bottoms
-        res.entries = self.entries
-        res.exits = self.exits
-        res.cancels = self.cancels
+        for i, k in enumerate(TRADER_STATE[STATE_BUYS:], STATE_BUYS):
+            setattr(res, k, int(self.state[i]))
         return res
 
     def balance(self) -> float:
@@ -111,102 +162,54 @@ class SimulatedTrader(ReadOnlyCachedClass, HistoricalMarketDataAPI, TradingAPI):
         self.buys += 1
 
     def sell(self, symbol: str, count: int, price: float):
-        if count > self.owned:
+        owned = self.owned
+        if count > owned:
             self.mistakes += 1
             return
 
         rc = rng.randint(count // 2, count)
         total = rc * price
 
-        if rc == self.shares:
+        # selling everything that was held closes the position
+        if rc == owned:
             self.exits += 1
 
         self.cash += total
-        self.owned -= rc
+        self.owned = owned - rc
         self.sells += 1
 
     def cancel_all(self):
         self.cancels += 1
 
     def historical_news(self, symbol: str, start: dt.datetime, dur: dt.timedelta) -> List[News]:
-        def checker(date: dt.datetime) -> bool:
-            return self.check_exists('news', symbol, date)
-
-        def loader(date: dt.datetime) -> List[News]:
-            rows = self.cache_lookup('news', condition='symbol = ? and date(updated_at) = ?',
-                                     params=(symbol, date.strftime(SQL_DATE_FMT)))
-            return [
-                News(symbol, dt.datetime.fromisoformat(ts), nid, a, h, u, dt.datetime.fromisoformat(ua))
-                for nid, _, ts, ua, a, h, u in rows
-            ]
-
-        collated = process_interval(truncate_datetime(start), dur,
-                                    default_empty_fetcher, loader, checker, default_empty_saver)
-
-        result = []
-        for c in collated:
-            result += c
-        return result
+        rows = self.lookup_interval('news', symbol, start, dur, 'updated_at', 'rowid asc')
+        return [
+            News(symbol, dt.datetime.fromisoformat(ts), nid, a, h, u, dt.datetime.fromisoformat(ua))
+            for nid, _, ts, ua, a, h, u in rows
+        ]
 
     def historical_bars(self, symbol: str,
                         start: dt.datetime, dur: dt.timedelta,
                         buckets: TimeFrame = TimeFrame.Minute) -> List[Bar]:
-        def checker(date: dt.datetime) -> bool:
-            return self.check_exists('bars', symbol, date)
-
-        def loader(date: dt.datetime) -> List[Bar]:
-            rows = self.cache_lookup('bars', condition='symbol = ? and date(timestamp) = ?',
-                                     params=(symbol, date.strftime(SQL_DATE_FMT)))
-            return [
-                Bar(symbol, dt.datetime.fromisoformat(ts), op, cl, h, l, vol)
-                for _, ts, op, cl, h, l, vol in rows
-            ]
-
-        collated = process_interval(truncate_datetime(start), dur,
-                                    default_empty_fetcher, loader, checker, default_empty_saver)
-
-        result = []
-        for c in collated:
-            result += c
-        return result
+        rows = self.lookup_interval('bars', symbol, start, dur)
+        return [
+            Bar(symbol, dt.datetime.fromisoformat(ts), op, cl, h, l, vol)
+            for _, ts, op, cl, h, l, vol in rows
+        ]
 
     def historical_quotes(self, symbol: str, start: dt.datetime, dur: dt.timedelta) -> List[HistoricalQuote]:
-        def checker(date: dt.datetime) -> bool:
-            return self.check_exists('quotes', symbol, date)
-
-        def loader(date: dt.datetime) -> List[HistoricalQuote]:
-            rows = self.cache_lookup('quotes', condition='symbol = ? and date(timestamp) = ?',
-                                     params=(symbol, date.strftime(SQL_DATE_FMT)))
-            return [
-                HistoricalQuote(symbol, dt.datetime.fromisoformat(ts), aex, asz, ap, bex, bs, bp)
-                for _, ts, aex, asz, ap, bex, bs, bp in rows
-            ]
-
-        collated = process_interval(truncate_datetime(start), dur,
-                                    default_empty_fetcher, loader, checker, default_empty_saver)
-        result = []
-        for c in collated:
-            result += c
-        return result
+        rows = self.lookup_interval('quotes', symbol, start, dur)
+        return [
+            HistoricalQuote(symbol, dt.datetime.fromisoformat(ts), aex, asz, ap, bex, bs, bp)
+            for _, ts, aex, asz, ap, bex, bs, bp in rows
+        ]
 
     def historical_trades(self, symbol: str, start: dt.datetime, dur: dt.timedelta) -> List[Trade]:
-        def checker(date: dt.datetime) -> bool:
-            return self.check_exists('trades', symbol, date)
-
-        def loader(date: dt.datetime) -> List[Trade]:
-            rows = self.cache_lookup('trades', condition='symbol = ? and date(timestamp) = ?',
-                                     params=(symbol, date.strftime(SQL_DATE_FMT)))
-            return [
-                Trade(symbol, dt.datetime.fromisoformat(ts), ex, sz, p)
-                for _, ts, ex, sz, p in rows
-            ]
-
-        collated = process_interval(truncate_datetime(start), dur,
-                                    default_empty_fetcher, loader, checker, default_empty_saver)
-        result = []
-        for c in collated:
-            result += c
-        return result
+        rows = self.lookup_interval('trades', symbol, start, dur)
+        return [
+            Trade(symbol, dt.datetime.fromisoformat(ts), ex, sz, p)
+            for _, ts, ex, sz, p in rows
+        ]
 
     def was_market_open(self, date: dt.datetime) -> bool:
-        return self.cache_check('bars_date_processed', condition='date = ?', params=(date.strftime(SQL_DATE_FMT),))
+        return self.cache_check('bars_date_processed', condition='date = ?', params=(sql_date(date),))
@@ -1,18 +1,33 @@
+import bisect
 import datetime as dt
-from typing import Dict, Callable, List, Tuple
+import functools
+from operator import attrgetter
+from typing import List
+
+import numpy as np
 
 from pystonks.facades import MarketDataAPI, HistoricalMarketDataAPI
 from pystonks.models import Trade
 from pystonks.supervised.annotations.models import TradeActions
-from pystonks.trading.simulated import SimulatedTrader, SimulationResults
+from pystonks.trading.simulated import SimulationResults, STATE_CASH, STATE_OWNED, STATE_BUYS, \
+    STATE_SELLS, STATE_MISTAKES, STATE_BOTTOMS, STATE_ENTRIES, STATE_EXITS
+from pystonks.utils.jit import njit
+
+HOLD = TradeActions.HOLD.value
+BUY_HALF = TradeActions.BUY_HALF.value
+SELL_HALF = TradeActions.SELL_HALF.value
+SELL_ALL = TradeActions.SELL_ALL.value
 
-Evaluator = Callable[[List[float], float, float], TradeActions]
+# windows to step from each weekday to the next weekday, friday and saturday jump to monday
+WEEKDAY_STEPS = (1, 1, 1, 1, 3, 2, 1)
 
 
 class StockIterator:
     def __init__(self, data: List[Trade]):
-        self.data = sorted(data, key=lambda d: d.timestamp)
-        self.initial = self.data[0].timestamp
+        self.data = sorted(data, key=attrgetter('timestamp'))
+        # pulled out once so the period searches compare datetimes directly
+        self.timestamps = [d.timestamp for d in self.data]
+        self.initial = self.timestamps[0]
         self.window = dt.timedelta(days=1)
         self.current: dt.datetime = self.initial + self.window
         self.ci = 0
@@ -22,68 +37,73 @@ class StockIterator:
         self.ci = 0
 
     def next(self) -> List[Trade]:
-        result = []
+        start = self.ci
 
-        while len(result) == 0:  # periods with no trades, kinda useless for training
-            while self.ci < len(self.data) and self.data[self.ci].timestamp < self.current:
-                result.append(self.data[self.ci])
-                self.ci += 1
+        # periods with no trades are skipped, kinda useless for training
+        while self.ci == start and self.ci < len(self.data):
+            # the trades are sorted, so the end of the period is found with a binary search
+            self.ci = bisect.bisect_left(self.timestamps, self.current, lo=self.ci)
 
             # skip weekends
-            self.current += self.window
-            while self.current.weekday() > 4:
-                self.current += self.window
+            self.current += self.window * WEEKDAY_STEPS[self.current.weekday()]
 
-        return result
+        return self.data[start:self.ci]
 
     def done(self) -> bool:
         return self.ci >= len(self.data)
 
 
-class StockSimulator:
+# days of trades kept around for the simulators, bounded since every one is a whole list of trade objects
+TRADE_CACHE_SIZE = 64
+
 
-    tfmt = '%j/%Y'
-    cache: Dict[str, List[Trade]] = {}
+@functools.lru_cache(maxsize=TRADE_CACHE_SIZE)
+def fetch_trades(trader: HistoricalMarketDataAPI, symbol: str, start: dt.date, days: int) -> List[Trade]:
+    # module level so that each worker process keeps its own cache
+    return trader.historical_trades(
+        symbol,
+        dt.datetime(start.year, start.month, start.day),
+        dt.timedelta(days=days))
+
+
+class StockSimulator:
 
     def __init__(self, t: HistoricalMarketDataAPI):
         self.trader = t
 
     def fetch_data(self, symbol: str, start: dt.date, days: int) -> List[Trade]:
-        td = dt.timedelta(days=days)
-        dsh = f'{start.strftime(self.tfmt)}>{(start + td).strftime(self.tfmt)}'
-        if dsh in StockSimulator.cache:
-            return StockSimulator.cache[dsh]
-        trades = self.trader.historical_trades(
-            symbol,
-            dt.datetime(start.year, start.month, start.day),
-            td)
-        StockSimulator.cache[dsh] = trades
-        return trades
+        return fetch_trades(self.trader, symbol, start, days)
 
     def get_iterator(self, symbol: str, start: dt.date, days: int) -> StockIterator:
         return StockIterator(self.fetch_data(symbol, start, days))
 
 
-def run_simulation(trader: SimulatedTrader, bars: List[Tuple[str, List[List[float]]]], ev: Evaluator) -> SimulationResults:
-    holds = 0
-    trader.reset()
-    ibalance = trader.balance()
-    for symbol, day_data in bars:
-        for dslice in day_data:
-            cash = trader.balance()
-            shares = trader.shares(symbol)
-            action = ev(dslice, cash, shares)
-            sprice = dslice[-4]
-            if action == TradeActions.BUY_HALF:
-                trader.buy((trader.balance() / 2) / sprice, sprice + 0.1)
-            elif action == TradeActions.SELL_HALF:
-                trader.sell(shares // 2, sprice - 0.1)
-            elif action == TradeActions.SELL_ALL:
-                trader.sell(shares, sprice - 0.1)
-            elif action == TradeActions.HOLD:
-                holds += 1
-            else:
-                raise Exception(f'unrecognized action {action.value}')
-    res = trader.get_results()
-    res.total_profit = trader.balance() - ibalance
-    return res
+@njit(cache=True)
+def trade_step(state: np.ndarray, action: int, sprice: float):
+    # the same bookkeeping as the trader's buy and sell, on a SimulatedTrader state array
+    if action == BUY_HALF:
+        count = int((state[STATE_CASH] / 2) / sprice)
+        price = sprice + 0.1
+        rc = np.random.randint(count // 2, count + 1)
+        total = rc * price
+        if state[STATE_CASH] < total:
+            state[STATE_MISTAKES] += 1
+            return
+        if state[STATE_CASH] == total:
+            state[STATE_BOTTOMS] += 1
+        if state[STATE_OWNED] == 0:
+            state[STATE_ENTRIES] += 1
+        state[STATE_CASH] -= total
+        state[STATE_OWNED] += rc
+        state[STATE_BUYS] += 1
+    elif action == SELL_HALF or action == SELL_ALL:
+        count = int(state[STATE_OWNED]) // 2 if action == SELL_HALF else int(state[STATE_OWNED])
+        price = sprice - 0.1
+        rc = np.random.randint(count // 2, count + 1)
+        if rc == state[STATE_OWNED]:
+            state[STATE_EXITS] += 1
+        state[STATE_CASH] += rc * price
+        state[STATE_OWNED] -= rc
+        state[STATE_SELLS] += 1
+    elif action != HOLD:
+        raise Exception('unrecognized action')
@@ -2,28 +2,36 @@ import argparse
 import datetime as dt
 import os
 import pathlib
-from typing import Optional, Callable, List, Tuple
+from collections import OrderedDict
+from typing import Optional, Callable, List, Tuple, Dict
 import random as rng
 
 import pygad
 import pygad.nn
 import pygad.gann
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 
-from pystonks.apis.sql import ReadOnlySqliteAPI
+from pystonks.apis.sql import ReadOnlySqliteAPI, sql_date
 from pystonks.supervised.annotations.models import TradeActions
 from pystonks.supervised.training.definitions import INPUT_COUNT
-from pystonks.supervised.training.trainer import flatten_bars
-from pystonks.trading.simulated import SimulatedTrader
-from pystonks.unsupervised.simulation import StockSimulator, run_simulation, SimulationResults
+from pystonks.trading.simulated import SimulatedTrader, STATE_CASH, STATE_OWNED
+from pystonks.unsupervised.simulation import StockSimulator, SimulationResults, trade_step
 from pystonks.utils.config import read_config
-from pystonks.utils.processing import fill_in_sparse_bars
+from pystonks.utils.jit import njit
+from pystonks.utils.processing import fill_in_sparse_bar_array
 
 
 SIMULATOR_VERSION = '1.0.0'
 
+# slices of a day pushed through the first layer together
+SLICE_BATCH = 512
+# prepared days kept between generations, about 140KB each
+DAY_CACHE_SIZE = 1024
 
-FITNESS_SCORER = Callable[[SimulationResults], float]
+
+# scores a batch of results at once
+FITNESS_SCORER = Callable[[List[SimulationResults]], np.ndarray]
 
 
 class ParallelGA(pygad.GA):
@@ -35,60 +43,136 @@ class ParallelGA(pygad.GA):
         self.scorer = scorer
         self.trader = trader
         self.gann = gann_instance
-        self.window_bars: List[Tuple[str, List[float]]] = []
+        self.window_bars: List[Tuple[str, np.ndarray]] = []
+        # least recently used first
+        self.day_windows: OrderedDict[Tuple[str, str], np.ndarray] = OrderedDict()
         self.pick_random_days()
 
     def pick_random_days(self):
         print('selecting random bar data')
-        symbols = self.trader.get_cached_symbols()
-        sample = rng.choices(symbols, k=self.days)
-        self.window_bars = []
-        for symbol in sample:
-            dates = self.trader.get_symbol_dates(symbol)
-            d = rng.choice(dates)
-            full_day = flatten_bars(fill_in_sparse_bars(
-                d, d + dt.timedelta(days=1), dt.timedelta(minutes=1),
-                self.trader.historical_bars(symbol, d, dt.timedelta(days=1))
-            ))
-            slices = []
-            for i in range(len(full_day)):
-                slice = full_day[:i+1]
-                diff = len(full_day) - len(slice)
-                slices.append([0.] * diff + slice)
-            self.window_bars.append((symbol, slices))
-
-
-def default_scorer(res: SimulationResults) -> float:
-    if res.sells == 0 or res.buys == 0:
-        return -10000
-    result = 20 * res.total_profit
-    comp = res.buys - 10
+        symbol_dates = self.trader.get_cached_symbol_dates()
+        sample = rng.choices(list(symbol_dates), k=self.days)
+        picks = [(symbol, rng.choice(symbol_dates[symbol])) for symbol in sample]
+        keys = [(symbol, sql_date(d)) for symbol, d in picks]
+
+        # the bars never change, so days that were picked before are reused and only the new ones are loaded
+        # the picks are held onto here, loading the new days can evict the reused ones from the cache
+        current: Dict[Tuple[str, str], np.ndarray] = {}
+        for key in keys:
+            if key in self.day_windows:
+                self.day_windows.move_to_end(key)
+                current[key] = self.day_windows[key]
+        missing = [(symbol, d) for (symbol, d), key in zip(picks, keys) if key not in current]
+        day_bars = self.trader.historical_bar_arrays_for_days(missing)
+        for (symbol, d), key in zip(missing, [(symbol, sql_date(d)) for symbol, d in missing]):
+            if key not in current:
+                current[key] = self.cache_day_windows(key, d, day_bars[key])
+        self.window_bars = [(symbol, current[key]) for (symbol, _), key in zip(picks, keys)]
+
+    def cache_day_windows(self, key: Tuple[str, str], d: dt.datetime, bars: np.ndarray) -> np.ndarray:
+        full_day = fill_in_sparse_bar_array(d, d + dt.timedelta(days=1), dt.timedelta(minutes=1), bars).reshape(-1)
+        if len(full_day) == 0:
+            windows = np.zeros((0, 0))
+        else:
+            # every prefix of the day right aligned in a row of zeros, as views into a single padded copy
+            padded = np.concatenate((np.zeros(len(full_day) - 1), full_day))
+            windows = sliding_window_view(padded, len(full_day))
+
+        if len(self.day_windows) >= DAY_CACHE_SIZE:
+            self.day_windows.popitem(last=False)
+        self.day_windows[key] = windows
+        return windows
+
+
+def default_scorer(results: List[SimulationResults]) -> np.ndarray:
+    buys = np.array([r.buys for r in results], dtype=np.float64)
+    sells = np.array([r.sells for r in results], dtype=np.float64)
+    penalties = np.array([r.mistakes + r.bottoms for r in results], dtype=np.float64)
+    result = 20 * np.array([r.total_profit for r in results], dtype=np.float64)
+    comp = buys - 10
     result += comp * comp / -10 + 10
-    comp = res.sells / (res.buys + 1) - 5
+    comp = sells / (buys + 1) - 5
     result += comp * comp / -2.5 + 10
-    result -= (res.mistakes + res.bottoms) * 30
-    return result
+    result -= penalties * 30
+    return np.where((sells == 0) | (buys == 0), -10000, result)
 
 
-def run_solution(ga_instance: ParallelGA, sol_idx) -> SimulationResults:
-    def eval_trades(fb: List[float], cash: float, shares: float) -> TradeActions:
-        predictions = pygad.nn.predict(
-            last_layer=ga_instance.gann.population_networks[sol_idx],
-            data_inputs=np.array([[cash, shares] + fb])
+ACTIVATIONS = {None: 0, 'relu': 1, 'sigmoid': 2, 'softmax': 3}
+
+
+@njit(cache=True)
+def _activate_kernel(outputs: np.ndarray, activation: int) -> np.ndarray:
+    # the same activations as pygad.nn
+    if activation == 1:
+        return np.maximum(outputs, 0.)
+    elif activation == 2:
+        return 1.0 / (1 + np.exp(-1 * outputs))
+    elif activation == 3:
+        return outputs / (np.sum(outputs) + 0.000001)
+    return outputs
+
+
+@njit(cache=True)
+def _simulate_day_kernel(state: np.ndarray, market: np.ndarray, cash_weights: np.ndarray, share_weights: np.ndarray,
+                         layers: np.ndarray, shapes: np.ndarray, activations: np.ndarray, prices: np.ndarray):
+    # the rest of the network and the trades for every slice of the day, the later layers are packed back to back
+    for di in range(market.shape[0]):
+        r1 = _activate_kernel(
+            market[di] + state[STATE_CASH] * cash_weights + state[STATE_OWNED] * share_weights, activations[0]
         )
-        return TradeActions(predictions[0])
+        offset = 0
+        for li in range(shapes.shape[0]):
+            rows, cols = shapes[li, 0], shapes[li, 1]
+            curr_weights = layers[offset:offset + rows * cols].reshape((rows, cols))
+            offset += rows * cols
+            r2 = np.zeros(cols)
+            for j in range(rows):
+                r2 += r1[j] * curr_weights[j]
+            r1 = _activate_kernel(r2, activations[li + 1])
+        trade_step(state, np.argmax(r1), prices[di])
+
+
+def window_products(windows: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    # the windows are strided views, so they're copied out a block at a time to let blas do the matmul
+    return np.concatenate([
+        np.ascontiguousarray(windows[i:i+SLICE_BATCH]) @ weights for i in range(0, len(windows), SLICE_BATCH)
+    ])
+
+
+def run_solution(ga_instance: ParallelGA, sol_idx) -> SimulationResults:
+    last_layer = ga_instance.gann.population_networks[sol_idx]
+    weights = [np.asarray(w, dtype=np.float64) for w in pygad.nn.layers_weights(last_layer, initial=False)]
+    activations = np.array([ACTIVATIONS[a] for a in pygad.nn.layers_activations(last_layer)], dtype=np.int64)
+    layers = np.concatenate([w.reshape(-1) for w in weights[1:]])
+    shapes = np.array([w.shape for w in weights[1:]], dtype=np.int64).reshape(-1, 2)
+
+    trader = ga_instance.trader
+    trader.reset()
+    ibalance = trader.balance()
+    state = trader.get_state()
+    for symbol, day_data in ga_instance.window_bars:
+        if len(day_data) == 0:
+            continue
+        # only the cash and shares inputs depend on the trades, the bar history's share of the
+        # first layer is computed for the whole day up front
+        market = window_products(day_data, weights[0][2:])
+        _simulate_day_kernel(state, market, weights[0][0], weights[0][1], layers, shapes, activations,
+                             np.ascontiguousarray(day_data[:, -4]))
 
-    return run_simulation(ga_instance.trader, ga_instance.window_bars, eval_trades)
+    res = trader.get_results()
+    res.total_profit = trader.balance() - ibalance
+    return res
 
 
-def fitness_func(ga_instance: ParallelGA, solution, sol_idx) -> float:
-    # If adaptive mutation is used, sometimes sol_idx is None.
-    if sol_idx is None:
-        sol_idx = 1
+def fitness_func(ga_instance: ParallelGA, solutions, sol_idxs) -> np.ndarray:
+    # called with the whole population at once, see fitness_batch_size
+    # If adaptive mutation is used, sol_idxs is None.
+    if sol_idxs is None:
+        sol_idxs = [1] * len(solutions)
 
-    result = run_solution(ga_instance, sol_idx)
+    results = [run_solution(ga_instance, sol_idx) for sol_idx in sol_idxs]
 
-    return ga_instance.scorer(result)
+    return ga_instance.scorer(results)
 
 
 def callback_generation(ga_instance: ParallelGA):
@@ -189,6 +273,7 @@ if __name__ == '__main__':
                              num_parents_mating=6,
                              initial_population=initial_population,
                              fitness_func=fitness_func,
+                             fitness_batch_size=args.pop_size,
                              init_range_low=-2,
                              init_range_high=5,
                              parent_selection_type='sss',
@@ -37,6 +37,7 @@ class TkFrameModule(TkBaseModule):
 
 class TkLabelModule(TkBaseModule):
     def __init__(self, default_value: str = '', dark: bool = False, master: Optional[tk.Misc] = None, **pack_kwargs):
+        self.text = default_value
         self.var = tk.StringVar(value=default_value)
         self.label = tk.Label(master, textvariable=self.var)
         super().__init__(self.label, dark, master, **pack_kwargs)
@@ -45,6 +46,10 @@ class TkLabelModule(TkBaseModule):
         self.label.configure(background=DARK_MODE_COLOR, foreground='white')
 
     def set(self, text: str):
+        # setting the variable redraws the label, even when the text is the same
+        if text == self.text:
+            return
+        self.text = text
         self.var.set(text)
 
 
@@ -0,0 +1,15 @@
+# numba is an optional speedup, when it isn't installed the kernels run as plain python
+try:
+    from numba import njit
+    JIT_ENABLED = True
+except ImportError:
+    JIT_ENABLED = False
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]) and len(kwargs) == 0:
+            return args[0]
+
+        def decorator(func):
+            return func
+
+        return decorator
@@ -1,14 +1,24 @@
-from typing import Callable, Any, List, Tuple, Awaitable
+from typing import Callable, Any, List, Tuple, Awaitable, Optional
+import bisect
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from operator import attrgetter
 import datetime as dt
 
 from alpaca.data import TimeFrame, TimeFrameUnit
+import numpy as np
 
 from pystonks.models import Bar, News, Trade
+from pystonks.utils.jit import njit, JIT_ENABLED
 
 
 DATED_CALLER = Callable[[dt.datetime], Any]
 DATED_CHECKER = Callable[[dt.datetime], bool]
 DATED_SAVER = Callable[[dt.datetime, Any], None]
+RANGED_CALLER = Callable[[dt.datetime, dt.datetime], list]
+
+INTERVAL_CACHE_SIZE = 256
 
 
 def truncate_datetime(current: dt.datetime) -> dt.datetime:
@@ -17,51 +27,145 @@ def truncate_datetime(current: dt.datetime) -> dt.datetime:
 
 def process_interval(start: dt.datetime, duration: dt.timedelta,
                      fetch: DATED_CALLER, load: DATED_CALLER, check: DATED_CHECKER, save: DATED_SAVER,
-                     exclusive_end: bool = True) -> list:
+                     exclusive_end: bool = True,
+                     cache: Optional[OrderedDict] = None, cache_size: int = INTERVAL_CACHE_SIZE,
+                     cache_key: tuple = ()) -> list:
+    # the cache is keyed on cache_key followed by the day, so one cache can be shared by several series
+    days = interval_days(start, duration, exclusive_end)
+
+    result = []
+    for current in days:
+        key = (*cache_key, truncate_datetime(current)) if cache is not None else None
+        if key is not None and key in cache:
+            # the cached day is shared by reference, callers only chain over it
+            cache.move_to_end(key)
+            data = cache[key]
+        else:
+            if check(current):
+                data = load(current)
+            else:
+                data = fetch(current)
+                save(current, data)
+            if key is not None:
+                cache[key] = data
+                if len(cache) > cache_size:
+                    cache.popitem(last=False)
+        result.append(data)
+    return result
+
+
+def interval_days(start: dt.datetime, duration: dt.timedelta, exclusive_end: bool = True) -> List[dt.datetime]:
+    # the days process_interval walks through
     current = start
     stop = start + duration
 
     if stop.date() >= dt.date.today() and not exclusive_end:
         raise Exception('invalid interval, end date is >= today')
 
-    result = []
+    days = []
     while (current < stop and exclusive_end) or (current <= stop and not exclusive_end):
-        if check(current):
-            data = load(current)
-        else:
-            data = fetch(current)
-            save(current, data)
-        result.append(data)
+        days.append(current)
         current += dt.timedelta(days=1)
+    return days
+
+
+def _day_offset(ts: dt.datetime, first: dt.datetime) -> int:
+    if ts.tzinfo is not None:
+        # naive days are treated as utc, the same as the apis do
+        ts = ts.astimezone(first.tzinfo) if first.tzinfo is not None else \
+            ts.astimezone(dt.timezone.utc).replace(tzinfo=None)
+    return (ts - first) // dt.timedelta(days=1)
+
+
+def process_interval_ranges(start: dt.datetime, duration: dt.timedelta,
+                            fetch: RANGED_CALLER, load: DATED_CALLER, check: DATED_CHECKER, save: DATED_SAVER,
+                            key: Callable[[Any], dt.datetime], exclusive_end: bool = True, workers: int = 1) -> list:
+    # same as process_interval, but each run of consecutive days that aren't cached is fetched with one request
+    # from the start of its first day to the end of its last, and split back into days with key
+    # with more than one worker the runs are fetched concurrently, loading and saving stays on this thread
+    days = interval_days(start, duration, exclusive_end)
+    cached = [check(d) for d in days]
+
+    runs = []
+    di = 0
+    while di < len(days):
+        if cached[di]:
+            di += 1
+            continue
+        end = di
+        while end < len(days) and not cached[end]:
+            end += 1
+        runs.append((di, end))
+        di = end
+
+    def fetch_run(run: Tuple[int, int]) -> list:
+        return fetch(days[run[0]], days[run[1] - 1] + dt.timedelta(days=1))
+
+    if workers > 1 and len(runs) > 1:
+        with ThreadPoolExecutor(max_workers=min(workers, len(runs))) as pool:
+            fetched = list(pool.map(fetch_run, runs))
+    else:
+        fetched = [fetch_run(r) for r in runs]
+
+    result = [None] * len(days)
+    for (first, end), items in zip(runs, fetched):
+        buckets = [[] for _ in range(end - first)]
+        for item in items:
+            offset = _day_offset(key(item), days[first])
+            if 0 <= offset < len(buckets):
+                buckets[offset].append(item)
+        for di, data in enumerate(buckets, first):
+            save(days[di], data)
+            result[di] = data
+
+    for di, day in enumerate(days):
+        if cached[di]:
+            result[di] = load(day)
     return result
 
 
-def change_since_news(bars: List[Bar], news: List[News], minimum: float) -> Tuple[float, int]:
-    nindex = 0
-    ibar = None
-    bindex = None
+def _first_crossing(closes: np.ndarray, base: float, minimum: float) -> int:
+    # index of the first close that's more than minimum above base, -1 if there isn't one
+    if len(closes) == 0:
+        return -1
+    cps = (closes - base) / base if base > 0. else np.zeros(len(closes))
+    above = cps > minimum
+    return int(np.argmax(above)) if above.any() else -1
 
-    news = sorted(news, key=lambda n: n.timestamp)
 
-    for bi, b in enumerate(bars):
-        if b.timestamp > news[nindex].updated_at:
-            ibar = b
-            bindex = bi
-            break
+def change_since_news(bars: List[Bar], news: List[News], minimum: float,
+                      assume_sorted: bool = False) -> Tuple[float, int]:
+    if not assume_sorted:
+        news = sorted(news, key=attrgetter('timestamp'))
 
-    if bindex is None:
+    # the bars are in time order, so the bar after each article is found with a binary search
+    timestamps = [b.timestamp for b in bars]
+    bindex = bisect.bisect_right(timestamps, news[0].updated_at)
+    if bindex == len(bars):
         return 0., len(bars)-1
+    ibar = bars[bindex]
+
+    closes = np.fromiter((b.close for b in bars), dtype=np.float64, count=len(bars))
+    position = bindex + 1
+    for article in news[1:]:
+        # between articles the baseline is fixed, so the first crossing is found with array ops
+        boundary = max(bisect.bisect_right(timestamps, article.updated_at, lo=position), position)
+        crossing = _first_crossing(closes[position:boundary], ibar.close, minimum)
+        if crossing >= 0:
+            bi = position + crossing
+            return float((closes[bi] - ibar.close) / ibar.close) if ibar.close > 0. else 0., bi
+        if boundary == len(bars):
+            break
 
-    for bi, b in enumerate(bars[bindex + 1:]):
-        if nindex < len(news)-1 and b.timestamp > news[nindex+1].updated_at:
-            nindex += 1
-            if b.close < ibar.close:
-                ibar = b
-            continue
-
-        cp = ((b.close - ibar.close) / ibar.close) if ibar.close > 0. else 0.
-        if cp > minimum:
-            return cp, bi + bindex + 1
+        # the bar after the next article can lower the baseline
+        if bars[boundary].close < ibar.close:
+            ibar = bars[boundary]
+        position = boundary + 1
+    else:
+        crossing = _first_crossing(closes[position:], ibar.close, minimum)
+        if crossing >= 0:
+            bi = position + crossing
+            return float((closes[bi] - ibar.close) / ibar.close) if ibar.close > 0. else 0., bi
 
     return ((((bars[-1].close - ibar.close) / ibar.close) if ibar.close > 0. else 0.)
             if bars[-1] != ibar else 0., len(bars)-1)
@@ -71,245 +175,417 @@ def datetime_to_second_offset(d: dt.datetime) -> int:
     return d.hour * 3600 + d.minute * 60 + d.second
 
 
+@njit(cache=True)
+def _sma_kernel(bars: np.ndarray, window: int) -> np.ndarray:
+    # running sum, each step adds the newest bar and drops the oldest
+    result = np.empty(len(bars) - window + 1, dtype=np.float64)
+    total = 0.
+    for i in range(window):
+        total += bars[i]
+    result[0] = total / window
+    for i in range(window, len(bars)):
+        total += bars[i] - bars[i-window]
+        result[i-window+1] = total / window
+    return result
+
+
 def create_smas_win(times: List[float], bars: List[float],
-                    windows: List[int], raw: bool = False) -> List[Tuple[List[float], List[float]]]:
+                    windows: List[int], raw: bool = False) -> List[Tuple[np.ndarray, np.ndarray]]:
     swin = sorted(windows)
     if len(swin) == 0 or len(bars) < swin[0]:
         return []
 
-    result_x = []
-    result_y = []
+    stimes = np.asarray(times)
+    values = np.asarray(bars, dtype=np.float64)
 
+    result = []
     if raw:
-        result_x.append(times)
-        result_y.append(bars)
-
-    for _ in swin:
-        result_x.append([])
-        result_y.append([])
+        result.append((stimes, values))
 
-    for i in range(swin[0], len(bars)+1):
-        for wi, win in enumerate(swin):
-            if i < win:
-                break
+    # each window is a running sum in the jitted kernel
+    for win in swin:
+        if win > len(bars):
+            result.append((stimes[:0], values[:0]))
+            continue
+        result.append((stimes[win-1:len(bars)], _sma_kernel(values, win)))
 
-            s = bars[i-win:i]
-            result_x[wi].append(times[i-1])
-            result_y[wi].append(sum(s) / len(s))
+    return result
 
-    result = []
-    for x, y in zip(result_x, result_y):
-        result.append((x, y))
 
-    return result
+def _sma_cumsum(bars: np.ndarray, window: int) -> np.ndarray:
+    # difference of prefix sums, the error grows with the length of the series
+    sums = np.empty(len(bars) + 1, dtype=np.float64)
+    sums[0] = 0
+    np.cumsum(bars, out=sums[1:])
+    return (sums[window:] - sums[:-window]) * (1. / window)
 
 
-def create_sma(times: List[float], bars: List[float], window: int) -> Tuple[List[float], List[float]]:
+def create_sma(times: List[float], bars: List[float], window: int,
+               method: str = 'rolling') -> Tuple[np.ndarray, np.ndarray]:
     if len(bars) < window:
-        return [], []
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+
+    values = np.asarray(bars, dtype=np.float64)
+    if method == 'rolling':
+        y = _sma_kernel(values, window)
+    elif method == 'cumsum':
+        y = _sma_cumsum(values, window)
+    else:
+        raise Exception(f'unrecognized sma method: {method}')
 
-    result_x = []
-    result_y = []
+    return np.asarray(times)[window-1:len(bars)], y
 
-    for i in range(window, len(bars)+1):
-        s = bars[i-window:i]
-        result_x.append(times[i-1])
-        result_y.append(sum(s) / len(s))
 
-    return result_x, result_y
+@njit(cache=True)
+def _continuous_sma_kernel(previous_bars: np.ndarray, bars: np.ndarray, window: int) -> np.ndarray:
+    # running sum over the previous day followed by the current one, the window only ever slides forward
+    series = np.concatenate((previous_bars, bars))
+    pcount = len(previous_bars)
+    result = np.empty(len(bars), dtype=np.float64)
+
+    # the first few windows borrow the tail of the previous day
+    lo = max(pcount - window, 0) if window > 1 else pcount
+    hi = lo
+    total = 0.
+    for i in range(1, len(bars)+1):
+        nlo = max(pcount - (window - (i - 1)), 0) if i < window else pcount + i - window
+        while hi < pcount + i:
+            total += series[hi]
+            hi += 1
+        while lo < nlo:
+            total -= series[lo]
+            lo += 1
+        result[i-1] = total / (hi - lo)
+    return result
 
 
 def create_continuous_sma(
         previous_bars: List[float],
         times: List[float], bars: List[float],
         window: int
-) -> Tuple[List[float], List[float]]:
+) -> Tuple[np.ndarray, np.ndarray]:
     if (len(previous_bars) + len(bars)) < window:
-        return [], []
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
 
-    result_x = []
-    result_y = []
-
-    for i in range(1, len(bars)+1):
-        if i < window:
-            diff = window - (i - 1)
-            s = previous_bars[-diff:] + bars[:i]
-        else:
-            s = bars[i-window:i]
-        result_x.append(times[i-1])
-        result_y.append(sum(s) / len(s))
+    # only the last window of the previous day can reach into the averages
+    return np.asarray(times)[:len(bars)], _continuous_sma_kernel(
+        np.asarray(previous_bars[-window:], dtype=np.float64), np.asarray(bars, dtype=np.float64), window
+    )
 
-    return result_x, result_y
 
+@njit(cache=True)
+def _ema_kernel(bars: np.ndarray, start: int, previous_ema: float, multiplier: float) -> np.ndarray:
+    result = np.empty(len(bars) - start, dtype=np.float64)
+    keep = 1 - multiplier
+    for i in range(start, len(bars)):
+        previous_ema = bars[i] * multiplier + previous_ema * keep
+        result[i - start] = previous_ema
+    return result
 
-def create_continuous_ema(
-        previous_bars: List[float],
-        times: List[float], bars: List[float],
-        window: int, smoothing: float
-) -> Tuple[List[float], List[float]]:
-    if (len(previous_bars) + len(bars)) < window:
-        return [], []
 
-    # first ema value is the sma
-    offset = 0
+def _ema_seed(previous_bars: List[float], bars: List[float], window: int) -> Tuple[float, int]:
+    # first ema value is the sma of the first full window, along with the index of the first bar after it
     if len(previous_bars) < window:
         diff = window - len(previous_bars)
-        offset = diff
-        previous_ema = sum(previous_bars + bars[:diff]) / window
-    else:
-        previous_ema = sum(previous_bars[-window:]) / window
+        return sum(bars[:diff], sum(previous_bars)) / window, diff
+    return sum(previous_bars[-window:]) / window, 0
 
-    result_x = []
-    result_y = []
 
+def _ema_from_seed(times: List[float], bars: List[float], window: int, smoothing: float,
+                   seed: float, offset: int) -> Tuple[np.ndarray, np.ndarray]:
     if offset >= len(bars):
-        return [], []
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+
+    return np.asarray(times)[offset:len(bars)], _ema_kernel(
+        np.asarray(bars, dtype=np.float64), offset, float(seed), smoothing / (1 + window)
+    )
 
-    ema_multiplier = smoothing / (1 + window)
-    def ema(previous: float, current: float) -> float:
-        return current * ema_multiplier + previous * (1 - ema_multiplier)
 
-    for i in range(offset, len(bars)):
-        current_ema = ema(previous_ema, bars[i])
-        result_x.append(times[i])
-        result_y.append(current_ema)
-        previous_ema = current_ema
+def create_continuous_ema(
+        previous_bars: List[float],
+        times: List[float], bars: List[float],
+        window: int, smoothing: float
+) -> Tuple[np.ndarray, np.ndarray]:
+    if (len(previous_bars) + len(bars)) < window:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
 
-    return result_x, result_y
+    seed, offset = _ema_seed(previous_bars, bars, window)
+    return _ema_from_seed(times, bars, window, smoothing, seed, offset)
 
 
 def create_ema(
         times: List[float], bars: List[float],
         window: int, smoothing: float
-) -> Tuple[List[float], List[float]]:
+) -> Tuple[np.ndarray, np.ndarray]:
     if len(bars) < window:
-        return [], []
-
-    # first ema value is the sma
-    offset = 0
-    previous_ema = sum(bars[:window]) / window
-
-    result_x = []
-    result_y = []
-
-    if offset >= len(bars):
-        return [], []
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+
+    seed, offset = _ema_seed([], bars, window)
+    return _ema_from_seed(times, bars, window, smoothing, seed, offset)
+
+
+@njit(cache=True)
+def _derivatives_kernel(times: np.ndarray, data: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    n = len(data)
+    d1 = np.empty(max(n - 1, 0), dtype=np.float64)
+    d2 = np.empty(max(n - 2, 0), dtype=np.float64)
+    for i in range(1, n):
+        d1[i-1] = (data[i] - data[i - 1]) / (times[i] - times[i - 1])
+    for i in range(1, n-1):
+        d2[i-1] = ((data[i+1] - 2 * data[i] + data[i - 1]) /
+                   ((times[i+1] - times[i]) * (times[i+1] - times[i])))
+    return d1, d2
 
-    ema_multiplier = smoothing / (1 + window)
-    def ema(previous: float, current: float) -> float:
-        return current * ema_multiplier + previous * (1 - ema_multiplier)
 
-    for i in range(window, len(bars)):
-        current_ema = ema(previous_ema, bars[i])
-        result_x.append(times[i])
-        result_y.append(current_ema)
-        previous_ema = current_ema
-
-    return result_x, result_y
+def _derivatives_vectorized(times: np.ndarray, data: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # same as the kernel, for when it isn't compiled
+    steps = np.diff(times)
+    d1 = np.diff(data) / steps
+    d2 = (data[2:] - 2 * data[1:-1] + data[:-2]) / (steps[1:] * steps[1:])
+    return d1, d2
 
 
-def calculate_derivatives(times: List[float], data: List[float]) -> Tuple[List[float], List[float]]:
-    d1 = [
-        (data[i] - data[i - 1]) / (times[i] - times[i - 1])
-        for i in range(1, len(data))
-    ]
+def calculate_derivatives(times: List[float], data: List[float]) -> Tuple[np.ndarray, np.ndarray]:
+    times = np.asarray(times, dtype=np.float64)
+    data = np.asarray(data, dtype=np.float64)
+    if JIT_ENABLED:
+        return _derivatives_kernel(times, data)
+    return _derivatives_vectorized(times, data)
 
-    d2 = [
-        (data[i+1] - 2 * data[i] + data[i - 1]) /
-        ((times[i+1] - times[i]) * (times[i+1] - times[i]))
-        for i in range(1, len(data)-1)
-    ]
 
+@njit(cache=True, error_model='numpy')
+def _bipolar_kernel(data: np.ndarray):
+    # normalize_bipolar in place, one pass for the bounds and one to scale
+    if len(data) == 0:
+        return
+    mn = data[0]
+    mx = data[0]
+    for i in range(1, len(data)):
+        if data[i] < mn:
+            mn = data[i]
+        elif data[i] > mx:
+            mx = data[i]
+    if mx == mn:
+        data[:] = 0.
+        return
+    for i in range(len(data)):
+        data[i] = data[i] / mx if data[i] > 0 else -(data[i] / mn)
+
+
+@njit(cache=True, error_model='numpy')
+def _normalized_derivatives_kernel(times: np.ndarray, data: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    d1, d2 = _derivatives_kernel(times, data)
+    _bipolar_kernel(d1)
+    _bipolar_kernel(d2)
     return d1, d2
 
 
 def calculate_normalized_derivatives(
         times: List[float], data: List[float]
-) -> Tuple[List[float], List[float]]:
+) -> Tuple[np.ndarray, np.ndarray]:
+    if JIT_ENABLED:
+        return _normalized_derivatives_kernel(
+            np.asarray(times, dtype=np.float64), np.asarray(data, dtype=np.float64)
+        )
     d1, d2 = calculate_derivatives(times, data)
     return normalize_bipolar(d1), normalize_bipolar(d2)
 
 
+@njit(cache=True)
+def _price_derivatives_kernel(
+        times: np.ndarray, data: np.ndarray, prices: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    n = len(data)
+    nd1 = np.zeros(max(n - 1, 0), dtype=np.float64)
+    nd2 = np.zeros(max(n - 2, 0), dtype=np.float64)
+    for i in range(1, n):
+        if prices[i-1] != 0:
+            nd1[i-1] = ((data[i] - data[i - 1]) / ((times[i] - times[i - 1]) * abs(prices[i-1]))) * 100
+    for i in range(1, n-1):
+        pdiff = prices[i] - prices[i-1]
+        if pdiff != 0:
+            nd2[i-1] = ((
+                (data[i + 1] - 2 * data[i] + data[i - 1]) /
+                ((times[i + 1] - times[i]) * (times[i + 1] - times[i]) * pdiff)
+            )) * 100
+    return nd1, nd2
+
+
 def calculate_normalized_price_derivatives(
         times: List[float], data: List[float], prices: List[float]
-) -> Tuple[List[float], List[float]]:
-    nd1 = [
-        (((data[i] - data[i - 1]) / ((times[i] - times[i - 1]) * abs(prices[i-1]))) if prices[i-1] != 0 else 0) * 100
-        for i in range(1, len(data))
-    ]
-
-    nd2 = [
-        ((
-            (data[i + 1] - 2 * data[i] + data[i - 1]) /
-            ((times[i + 1] - times[i]) * (times[i + 1] - times[i]) * (prices[i] - prices[i-1]))
-        ) if (prices[i] - prices[i-1]) != 0 else 0) * 100
-        for i in range(1, len(data) - 1)
-    ]
+) -> Tuple[np.ndarray, np.ndarray]:
+    return _price_derivatives_kernel(
+        np.asarray(times, dtype=np.float64),
+        np.asarray(data, dtype=np.float64),
+        np.asarray(prices, dtype=np.float64)
+    )
+
+
+def calculate_normalized_price_derivatives_batch(
+        times: np.ndarray, data: np.ndarray, prices: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    # same as calculate_normalized_price_derivatives, but for a (metrics, T) stack of series
+    # padded on the right, prices lines up with the columns
+    prices = np.asarray(prices, dtype=np.float64)[:data.shape[1]]
+    dtimes = np.diff(times, axis=1)
+    pprev = prices[:-1]
+    pdiff = np.diff(prices)[:-1]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        nd1 = np.where(pprev != 0, (np.diff(data, axis=1) / (dtimes * np.abs(pprev))) * 100, 0.)
+        nd2 = np.where(
+            pdiff != 0,
+            ((data[:, 2:] - 2 * data[:, 1:-1] + data[:, :-2]) / (dtimes[:, 1:] * dtimes[:, 1:] * pdiff)) * 100,
+            0.
+        )
     return nd1, nd2
 
 
-def normalize(data: List[float]) -> List[float]:
-    mn = min(data)
-    mx = max(data)
-    return [(d - mn) / (mx - mn) for d in data]
+def normalize(data: List[float]) -> np.ndarray:
+    data = np.asarray(data, dtype=np.float64)
+    if len(data) == 0:
+        return data
+
+    mn = data.min()
+    mx = data.max()
+    if mx == mn:
+        return np.zeros(len(data), dtype=np.float64)
+    return (data - mn) / (mx - mn)
 
 
-def normalize_bipolar(data: List[float]) -> List[float]:
+def normalize_bipolar(data: List[float]) -> np.ndarray:
+    data = np.asarray(data, dtype=np.float64)
     if len(data) == 0:
-        return []
+        return data
 
-    mn = min(data)
-    mx = max(data)
-    return [(d / mx) if d > 0 else -(d / mn) for d in data] if mx != mn else ([0]*len(data))
+    mn = data.min()
+    mx = data.max()
+    if mx == mn:
+        return np.zeros(len(data), dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(data > 0, data / mx, -(data / mn))
 
 
-def timeframe_to_delta(tf: TimeFrame) -> dt.timedelta:
-    if tf.unit != TimeFrameUnit.Month:
+@lru_cache(maxsize=None)
+def _unit_delta(unit: TimeFrameUnit, amount: int) -> dt.timedelta:
+    if unit != TimeFrameUnit.Month:
         return dt.timedelta(
             **{
-                tf.unit.name.lower() + 's': tf.amount
+                unit.name.lower() + 's': amount
             }
         )
     return dt.timedelta(days=30)  # TODO this is a limitation
 
 
-def fill_in_sparse_bars(start: dt.datetime, stop: dt.datetime, delta: dt.timedelta, bars: List[Bar]) -> List[Bar]:
+def timeframe_to_delta(tf: TimeFrame) -> dt.timedelta:
+    # TimeFrame hashes by identity and every TimeFrame.Minute is a new one, so the cache is keyed on its fields
+    return _unit_delta(tf.unit, tf.amount)
+
+
+def fill_in_sparse_bars(start: dt.datetime, stop: dt.datetime, delta: dt.timedelta, bars: List[Bar],
+                        assume_sorted: bool = False) -> List[Bar]:
     if len(bars) == 0:
         return []
 
     result = []
-    bars = sorted(bars, key=lambda b: b.timestamp)
+    if not assume_sorted:
+        bars = sorted(bars, key=attrgetter('timestamp'))
 
     symbol = bars[0].symbol
     date = truncate_datetime(start)
-    init = start
-    sinit = datetime_to_second_offset(init)
-    nearest_bucket = sinit - (sinit % int(delta.total_seconds()))
+    sinit = datetime_to_second_offset(start)
+    step = int(delta.total_seconds())
+    span = (stop - date).total_seconds()
 
-    bstart = nearest_bucket
-    nts = bstart + int(delta.total_seconds())
-    previous = Bar(symbol, init, 0, 0, 0, 0, 0)
-    bts = date + dt.timedelta(seconds=nts)
+    # the buckets are walked in whole seconds, datetimes are only built for the filler bars
+    nts = sinit - (sinit % step) + step
+    pc = 0
 
     for b in bars:
-        sts = datetime_to_second_offset(b.timestamp)
-        while sts > nts:
-            result.append(Bar(symbol, bts, previous.close, previous.close, previous.close, previous.close, 0))
-            bts += delta
-            nts += int(delta.total_seconds())
+        sts = b.second_offset
+        if sts > nts:
+            # the empty buckets in between are filled in one go
+            skip = -((nts - sts) // step)
+            result.extend(
+                Bar(symbol, date + dt.timedelta(seconds=nts + k * step), pc, pc, pc, pc, 0) for k in range(skip)
+            )
+            nts += skip * step
         result.append(b)
-        previous = b
-        bts += delta
-        nts += int(delta.total_seconds())
+        pc = b.close
+        nts += step
+
+    while nts < span:
+        result.append(Bar(symbol, date + dt.timedelta(seconds=nts), pc, pc, pc, pc, 0))
+        nts += step
+
+    return result
 
-    while bts < stop:
-        result.append(Bar(symbol, bts, previous.close, previous.close, previous.close, previous.close, 0))
-        bts += delta
-        nts += int(delta.total_seconds())
 
+@njit(cache=True)
+def _fill_bar_array_kernel(bars: np.ndarray, first: int, step: int, span: int) -> np.ndarray:
+    # filler rows copy the previous close, the first few copy an all zero bar
+    count = bars.shape[0] + (max(int(bars[:, 0].max()), span) - first) // step + 2
+    result = np.zeros((count, 6), dtype=np.float64)
+    close = 0.
+    nts = first + step
+    k = 0
+    for i in range(bars.shape[0]):
+        while bars[i, 0] > nts:
+            result[k, 0] = nts % 86400
+            result[k, 1:5] = close
+            k += 1
+            nts += step
+        result[k] = bars[i]
+        close = bars[i, 2]
+        k += 1
+        nts += step
+
+    while nts < span:
+        result[k, 0] = nts % 86400
+        result[k, 1:5] = close
+        k += 1
+        nts += step
+
+    return result[:k]
+
+
+def _fill_bar_array_vectorized(bars: np.ndarray, first: int, step: int, span: int) -> np.ndarray:
+    # same rows as the kernel, for when it isn't compiled
+    # each bar lands after the buckets it skipped, or right after the bar before it if it skipped none
+    index = np.arange(bars.shape[0])
+    skipped = (-((first - bars[:, 0]) // step) - 1).astype(np.int64) - index
+    slots = index + np.maximum(np.maximum.accumulate(skipped), 0)
+
+    count = int(slots[-1]) + 1
+    tail = -((first + step * (count + 1) - span) // step)
+    count += max(tail, 0)
+
+    result = np.zeros((count, 6), dtype=np.float64)
+    result[:, 0] = (first + step * np.arange(1, count + 1)) % 86400
+
+    # forward fill the close of the latest bar, the rows before the first bar stay zero
+    owner = np.full(count, -1, dtype=np.int64)
+    owner[slots] = index
+    np.maximum.accumulate(owner, out=owner)
+    filled = owner >= 0
+    result[filled, 1:5] = bars[owner[filled], 2][:, None]
+    result[slots] = bars
     return result
 
 
+def fill_in_sparse_bar_array(start: dt.datetime, stop: dt.datetime, delta: dt.timedelta,
+                             bars: np.ndarray) -> np.ndarray:
+    # same as fill_in_sparse_bars, but on time sorted (offset, open, close, high, low, volume) rows
+    if bars.shape[0] == 0:
+        return bars
+    step = int(delta.total_seconds())
+    sinit = datetime_to_second_offset(start)
+    span = int((stop - truncate_datetime(start)).total_seconds())
+    if JIT_ENABLED:
+        return _fill_bar_array_kernel(bars, sinit - (sinit % step), step, span)
+    return _fill_bar_array_vectorized(bars, sinit - (sinit % step), step, span)
+
+
 def trim_zero_bars(bars: List[Bar]) -> List[Bar]:
     index = -1
     for bi, b in enumerate(bars):
@@ -321,27 +597,31 @@ def trim_zero_bars(bars: List[Bar]) -> List[Bar]:
     return bars
 
 
-def find_bars(delta: dt.timedelta, trades: List[Trade]) -> List[Bar]:
+def find_bars(delta: dt.timedelta, trades: List[Trade], assume_sorted: bool = False) -> List[Bar]:
     if len(trades) == 0:
         return []
     result = []
-    trades = sorted(trades, key=lambda t: t.timestamp)
+    if not assume_sorted:
+        trades = sorted(trades, key=attrgetter('timestamp'))
 
     symbol = trades[0].symbol
     date = truncate_datetime(trades[0].timestamp)
     init = trades[0].timestamp
     sinit = datetime_to_second_offset(init)
-    nearest_bucket = sinit - (sinit % int(delta.total_seconds()))
+    step = int(delta.total_seconds())
+    nearest_bucket = sinit - (sinit % step)
 
     start = nearest_bucket
-    nts = start + int(delta.total_seconds())
+    nts = start + step
     o, c, l, h, v = 0, 0, 0, 0, 0
     ct = 0
     first = True
     bts = date + dt.timedelta(seconds=start)
     for t in trades:
         p = t.price
-        sts = datetime_to_second_offset(t.timestamp)
+        # datetime_to_second_offset inlined, this runs once per trade
+        ts = t.timestamp
+        sts = ts.hour * 3600 + ts.minute * 60 + ts.second
         if sts <= nts:
             if first:
                 o = p
@@ -360,15 +640,16 @@ def find_bars(delta: dt.timedelta, trades: List[Trade]) -> List[Bar]:
                 symbol, bts, o, c, h, l, v
             ))
             start = nts
-            nts += int(delta.total_seconds())
+            nts += step
+            if sts > nts:
+                # the empty buckets in between are filled in one go
+                skip = -((nts - sts) // step)
+                result.extend(
+                    Bar(symbol, date + dt.timedelta(seconds=start + k * step), c, c, c, c, 0) for k in range(skip)
+                )
+                start += skip * step
+                nts += skip * step
             bts = date + dt.timedelta(seconds=start)
-            while sts > nts:
-                result.append(Bar(
-                    symbol, bts, c, c, c, c, 0
-                ))
-                start = nts
-                nts += int(delta.total_seconds())
-                bts = date + dt.timedelta(seconds=start)
             o = p
             l = p
             h = p
@@ -382,50 +663,36 @@ def find_bars(delta: dt.timedelta, trades: List[Trade]) -> List[Bar]:
     return result
 
 
+def _price_columns(bars: List[Bar]) -> np.ndarray:
+    # (open, close, high, low) of each bar as rows of one array
+    return np.array([(b.open, b.close, b.high, b.low) for b in bars], dtype=np.float64).reshape(-1, 4)
+
+
+def _percent_bars(bars: List[Bar], prices: np.ndarray) -> List[Bar]:
+    return [
+        Bar(b.symbol, b.timestamp, op, cl, h, lw, b.volume)
+        for b, (op, cl, h, lw) in zip(bars, prices.tolist())
+    ]
+
+
 def generate_percentages_since_previous_from_bars(bars: List[Bar]) -> List[Bar]:
     if len(bars) < 2:
         return []
 
-    def percent_change(new: float, old: float) -> float:
-        return ((new - old) / old) if old != 0 else 0
-
-    result = []
-    previous = bars[0]
-    for b in bars[1:]:
-        pb = Bar(
-            b.symbol,
-            b.timestamp,
-            percent_change(b.open, previous.open),
-            percent_change(b.close, previous.close),
-            percent_change(b.high, previous.high),
-            percent_change(b.low, previous.low),
-            b.volume
-        )
-        result.append(pb)
-        previous = b
-
-    return result
+    prices = _price_columns(bars)
+    old = prices[:-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        changes = np.where(old != 0, (prices[1:] - old) / old, 0.)
+    return _percent_bars(bars[1:], changes)
 
 
 def generate_percentages_since_bar_from_bars(reference: Bar, bars: List[Bar]) -> List[Bar]:
     if len(bars) == 0:
         return []
 
-    def percent_change(new: float, old: float) -> float:
-        return (new - old) / old
-
-    result = []
+    # the price columns are a fresh array, so the change is worked out in place
     first = reference.close
-    for b in bars:
-        pb = Bar(
-            b.symbol,
-            b.timestamp,
-            percent_change(b.open, first),
-            percent_change(b.close, first),
-            percent_change(b.high, first),
-            percent_change(b.low, first),
-            b.volume
-        )
-        result.append(pb)
-
-    return result
+    prices = _price_columns(bars)
+    prices -= first
+    prices /= first
+    return _percent_bars(bars, prices)
@@ -10,7 +10,8 @@ from pystonks.apis.sql import SqliteAPI, SqliteController
 from pystonks.trading.alpaca import AlpacaTrader
 from pystonks.utils.config import read_config
 from pystonks.utils.processing import find_bars, timeframe_to_delta, fill_in_sparse_bars, truncate_datetime, \
-    datetime_to_second_offset, calculate_normalized_derivatives, change_since_news
+    datetime_to_second_offset, calculate_normalized_derivatives, change_since_news, create_continuous_sma, \
+    process_interval_ranges
 
 
 class ProcessingTestCase(unittest.TestCase):
@@ -72,5 +73,56 @@ class ProcessingTestCase(unittest.TestCase):
         self.assertLessEqual(idx, 800, 'change index should match spike in price')
 
 
+
+class IndicatorTestCase(unittest.TestCase):
+    def test_continuous_sma(self):
+        previous = [1., 2., 3., 4., 5.]
+        closes = [6., 7., 8., 9., 10., 11.]
+        times, sma = create_continuous_sma(previous, list(range(len(closes))), closes, 3)
+        self.assertEqual(list(times), list(range(len(closes))))
+
+        # once the window is filled by the current day it shouldn't depend on the previous one
+        expected = [sum(closes[i-3:i]) / 3 for i in range(3, len(closes) + 1)]
+        for a, e in zip(sma[2:], expected):
+            self.assertAlmostEqual(a, e)
+        self.assertTrue(all(previous[0] < a < closes[1] for a in sma[:2]), 'first windows borrow the previous day')
+
+    def test_continuous_sma_short_history(self):
+        times, sma = create_continuous_sma([1.], [0, 1], [2., 3.], 5)
+        self.assertEqual(len(times), 0, 'not enough data for a single window')
+        self.assertEqual(len(sma), 0)
+
+
+class IntervalTestCase(unittest.TestCase):
+    def test_ranges_fetch_uncached_runs_once(self):
+        start = dt.datetime(2024, 7, 1, tzinfo=dt.timezone.utc)
+        cached = {start + dt.timedelta(days=2)}
+        requests = []
+        saved = []
+
+        def fetch(begin: dt.datetime, end: dt.datetime) -> list:
+            requests.append((begin, end))
+            return [
+                begin + dt.timedelta(hours=h)
+                for h in range(0, int((end - begin).total_seconds() // 3600), 12)
+            ]
+
+        result = process_interval_ranges(
+            start, dt.timedelta(days=5), fetch, lambda d: ['cached'], lambda d: d in cached,
+            lambda d, data: saved.append(d), lambda t: t, workers=2
+        )
+
+        self.assertCountEqual(requests, [
+            (start, start + dt.timedelta(days=2)),
+            (start + dt.timedelta(days=3), start + dt.timedelta(days=5)),
+        ])
+        self.assertEqual(len(saved), 4)
+        self.assertEqual(len(result), 5)
+        self.assertEqual(result[2], ['cached'])
+        for di in [0, 1, 3, 4]:
+            day = start + dt.timedelta(days=di)
+            self.assertEqual(result[di], [day, day + dt.timedelta(hours=12)])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -10,7 +10,8 @@ class ReadOnlyCacheAPI(ABC):
         pass
 
     def exists(self, name: str, columns: str = '*', condition: str = '', params: Optional[tuple] = None) -> bool:
-        return len(self.select(name, columns, condition, params=params)) > 0
+        # only whether a row matches matters, so at most one is read back
+        return len(self.select(name, '1', condition, 'limit 1', params)) > 0
 
     @abstractmethod
     def custom_query(self, query: str, params: Optional[tuple] = None) -> List[tuple]:
@@ -3,8 +3,6 @@ import datetime as dt
 import multiprocessing as mp
 from typing import Optional
 
-import jsonpickle
-
 
 class Message:
     def __init__(self, name: str, ack: bool = True):
@@ -108,10 +106,10 @@ class QueueChannel(CommChannel):
 
     def put(self, msg: Message, block: bool = True, timeout: Optional[float] = None):
         msg.index = self.index
-        self.queue.put(jsonpickle.encode(msg), block, timeout)
+        self.queue.put(msg, block, timeout)
 
     def get(self, block: bool = True, timeout: Optional[float] = None) -> Message:
-        return jsonpickle.decode(self.callback_queue.get(block, timeout))
+        return self.callback_queue.get(block, timeout)
 
 
 class CommsManager(ABC):
@@ -153,11 +151,11 @@ class QueueManager(CommsManager):
         return QueueChannel(self.q, self.cq)
 
     def get_msg(self, block: bool = True, timeout: Optional[float] = None) -> Message:
-        return jsonpickle.decode(self.q.get(block, timeout))
+        return self.q.get(block, timeout)
 
     def send_msg(self, msg: Message, block: bool = True, timeout: Optional[float] = None):
-        self.cq.put(jsonpickle.encode(msg), block, timeout)
+        self.cq.put(msg, block, timeout)
 
     def close(self):
-        self.q.put(jsonpickle.encode(KillMessage()))
+        self.q.put(KillMessage())
 